@@ -1,26 +1,47 @@
 import yt_dlp
-from pydub import AudioSegment
+import asyncio
+import functools
+import threading
+from collections import OrderedDict, deque
+from queue import Queue, Empty, Full
+import multiprocessing
+from concurrent.futures import ThreadPoolExecutor, ProcessPoolExecutor
 import subprocess
+import shutil
 import json
 import os
 import re
+import html as html_lib
 import trafilatura
 import uuid
+import time
+import math
+import hashlib
+from urllib.parse import urlsplit, urlunsplit, parse_qsl, urlencode
 import requests
+import httpx
 from openai import OpenAI
 from markitdown import MarkItDown
-from telegram import InlineKeyboardButton, InlineKeyboardMarkup
-from telegram.ext import CommandHandler, MessageHandler, CallbackQueryHandler, filters, ApplicationBuilder
+from telegram import InlineKeyboardButton, InlineKeyboardMarkup, Update
+from telegram.ext import CommandHandler, MessageHandler, CallbackQueryHandler, filters, ApplicationBuilder, BaseUpdateProcessor, BaseRateLimiter
 from bs4 import BeautifulSoup
 from telegram.helpers import escape_markdown
-from pymongo import MongoClient
-from datetime import datetime
+from telegram.error import BadRequest, RetryAfter
+from pymongo import MongoClient, ReturnDocument
+from pymongo.errors import BulkWriteError, OperationFailure
+import zlib
+try:
+    import zstandard
+except ImportError:  # 未安裝 zstandard 時原始內容改用標準函式庫的 zlib 壓縮
+    zstandard = None
+from datetime import datetime, timedelta
 import feedparser
 import markdown
 
 import smtplib
 from email.mime.multipart import MIMEMultipart
 from email.mime.text import MIMEText
+from email.utils import parsedate_to_datetime
 
 # 從環境變數中提取 SMTP 設定
 smtp_server = os.environ.get("SMTP_SERVER", "smtp.gmail.com")
@@ -149,11 +170,127 @@ show_processing = int(os.environ.get("SHOW_PROCESSING", "1"))
 # 其他設定
 lang = os.environ.get("TS_LANG", "繁體中文")
 chunk_size = int(os.environ.get("CHUNK_SIZE", 2100))
+chunk_unit = os.environ.get("CHUNK_UNIT", "chars")  # CHUNK_SIZE 的單位：chars (字元) 或 tokens (估計 token 數)
 use_audio_fallback = int(os.environ.get("USE_AUDIO_FALLBACK", "0"))
 
+# 分段摘要 (map-reduce) 設定：輸入超過門檻時先將各段並行整理成筆記，再由筆記產生六段式摘要
+map_reduce_threshold_tokens = int(os.environ.get("MAP_REDUCE_THRESHOLD_TOKENS", 24000))  # 超過此估計 token 數才分段
+map_reduce_chunk_tokens = int(os.environ.get("MAP_REDUCE_CHUNK_TOKENS", 8000))  # 每段的估計 token 數
+map_reduce_fan_out = int(os.environ.get("MAP_REDUCE_FAN_OUT", 4))  # 同時進行的分段摘要請求數
+map_reduce_max_rounds = max(1, int(os.environ.get("MAP_REDUCE_MAX_ROUNDS", 3)))  # 筆記仍超過門檻時最多再整理的輪數
+# 依模型覆寫上面三個設定，JSON 格式，例如 {"gemini-flash-latest": {"threshold": 200000, "chunk_tokens": 50000, "fan_out": 8}}
+map_reduce_model_settings = json.loads(os.environ.get("MAP_REDUCE_MODEL_SETTINGS", "") or "{}")
+followup_context_tokens = int(os.environ.get("FOLLOWUP_CONTEXT_TOKENS", 8000))  # 續問時原始內容 + 摘要 + 對話的 token 上限
+
 # GROQ API Key (用於 Whisper 語音轉文字)
 groq_api_key = os.environ.get("GROQ_API_KEY", "YOUR_GROQ_API_KEY")
 
+# 執行器設定：所有阻塞工作 (requests、yt-dlp、ffmpeg、pymongo、SMTP) 都丟到這裡執行，
+# event loop 只負責 Telegram I/O
+io_workers = int(os.environ.get("IO_WORKERS", 16))  # 執行緒池大小 (網路 / 磁碟 / 資料庫)
+cpu_workers = int(os.environ.get("CPU_WORKERS", 2))  # 行程池大小 (文件轉換等 CPU 密集工作)
+io_executor = ThreadPoolExecutor(max_workers=io_workers, thread_name_prefix="io-worker")
+_cpu_executor = None
+
+def get_cpu_executor():
+    """延遲建立行程池，避免 spawn 出來的子行程在 import 時又各自建立一組"""
+    global _cpu_executor
+    if _cpu_executor is None:
+        # 使用 spawn：主行程已有多個執行緒，fork 可能複製到被鎖住的 lock
+        _cpu_executor = ProcessPoolExecutor(
+            max_workers=cpu_workers,
+            mp_context=multiprocessing.get_context("spawn"),
+        )
+    return _cpu_executor
+
+async def run_blocking(func, *args, **kwargs):
+    """在執行緒池中執行阻塞函數並 await 結果"""
+    loop = asyncio.get_running_loop()
+    return await loop.run_in_executor(io_executor, functools.partial(func, *args, **kwargs))
+
+async def run_cpu_bound(func, *args, **kwargs):
+    """在行程池中執行 CPU 密集函數並 await 結果 (func 必須是模組層級、可 pickle 的函數)"""
+    loop = asyncio.get_running_loop()
+    return await loop.run_in_executor(get_cpu_executor(), functools.partial(func, *args, **kwargs))
+
+def shutdown_executors():
+    io_executor.shutdown(wait=False, cancel_futures=True)
+    whisper_executor.shutdown(wait=False, cancel_futures=True)
+    if _cpu_executor is not None:
+        _cpu_executor.shutdown(wait=False, cancel_futures=True)
+
+# 並行處理 update 的設定
+max_concurrent_updates = int(os.environ.get("MAX_CONCURRENT_UPDATES", 64))  # 全域同時處理的 update 上限
+max_concurrent_heavy_updates = int(os.environ.get("MAX_CONCURRENT_HEAVY_UPDATES", 16))  # 摘要等長任務的同時上限
+
+# 這些命令不需要等待同一聊天室中正在進行的摘要，永遠立即處理
+UNORDERED_COMMANDS = {'start', 'help', 'lang', 'language', 'model', 'boa', 'context', 'stats'}
+
+class ChatOrderedUpdateProcessor(BaseUpdateProcessor):
+    """
+    不同聊天室、不同用戶的 update 並行處理；同一用戶在同一聊天室的摘要、續問、檔案依照收到的順序逐一處理。
+    摘要交給背景 worker 時，只有可能是續問的訊息 (非網址的短文字) 會等到該用戶的工作送達後才處理，
+    其他訊息 (例如新的網址) 與群組中其他成員的訊息不必等待長時間的轉錄工作。
+    輕量命令與按鈕點擊不需排隊，也不佔用長任務的名額，長任務執行時 /start、/help 仍能即時回應。
+    排隊中的 update 不佔用全域名額：先取得順序鎖與長任務名額，最後才取得全域名額。
+    """
+
+    def __init__(self, max_concurrent_updates, max_concurrent_heavy_updates):
+        super().__init__(max_concurrent_updates)
+        self._heavy_semaphore = asyncio.BoundedSemaphore(max_concurrent_heavy_updates)
+        self._order_locks = {}  # (chat_id, user_id) -> [asyncio.Lock, 等待中的 update 數量]
+
+    @staticmethod
+    def needs_ordering(update):
+        """判斷 update 是否需要依聊天室順序處理"""
+        if not isinstance(update, Update) or update.effective_chat is None:
+            return False
+        if update.callback_query:
+            return False
+        message = update.effective_message
+        if message is None:
+            return False
+        text = message.text or ""
+        if text.startswith('/'):
+            command = text[1:].split(maxsplit=1)[0].split('@')[0].lower() if len(text) > 1 else ""
+            return command not in UNORDERED_COMMANDS
+        return True
+
+    async def process_update(self, update, coroutine):
+        # 基底類別會先佔用全域名額才呼叫 do_process_update，等待聊天室鎖或長任務名額的 update
+        # 會把全域名額耗盡，因此改在 do_process_update 內排隊完成後才取得全域名額
+        await self.do_process_update(update, coroutine)
+
+    async def do_process_update(self, update, coroutine):
+        if not self.needs_ordering(update):
+            async with self._semaphore:
+                await coroutine
+            return
+
+        chat_id = update.effective_chat.id
+        user_id = update.effective_user.id if update.effective_user else None
+        key = (chat_id, user_id)
+        entry = self._order_locks.setdefault(key, [asyncio.Lock(), 0])
+        entry[1] += 1
+        try:
+            # asyncio.Lock 依照 FIFO 喚醒等待者，同一用戶在同一聊天室的 update 會依序執行
+            async with entry[0]:
+                if is_followup_candidate(update.effective_message.text or ""):
+                    await wait_for_pending_summary_jobs(chat_id, user_id)
+                async with self._heavy_semaphore:
+                    async with self._semaphore:
+                        await coroutine
+        finally:
+            entry[1] -= 1
+            if entry[1] == 0:
+                del self._order_locks[key]
+
+    async def initialize(self):
+        pass
+
+    async def shutdown(self):
+        pass
+
 # 可用的 LLM 模型列表 (由 LLM_MODEL 和 LLM2_MODEL 組成)
 def get_available_models():
     models = []
@@ -168,9 +305,245 @@ ANSWER_BOOK_API = os.environ.get("ANSWER_BOOK_API", "http://answerbook.david888.
 
 # 添加 mongodb 紀錄功能
 mongo_uri = os.environ.get("MONGO_URI", "")
-mongo_client = MongoClient(mongo_uri)
-db = mongo_client["bot_database"]
-summary_collection = db["summaries"]
+mongo_database_name = "bot_database"
+mongo_max_pool_size = int(os.environ.get("MONGO_MAX_POOL_SIZE", 50))  # 連線池上限 (執行緒池 + 背景寫入共用)
+mongo_min_pool_size = int(os.environ.get("MONGO_MIN_POOL_SIZE", 0))
+mongo_timeout_ms = int(os.environ.get("MONGO_TIMEOUT_MS", 3000))  # 選擇伺服器 / 建立連線的逾時，MongoDB 無法連線時快速失敗
+summary_record_ttl = int(os.environ.get("SUMMARY_RECORD_TTL", 0))  # 摘要紀錄保存秒數，0 表示永久
+job_record_ttl = int(os.environ.get("JOB_RECORD_TTL", 7 * 24 * 3600))  # 已結束的摘要工作保存秒數，0 表示永久
+
+_mongo_client = None
+_mongo_client_lock = threading.Lock()
+
+def get_mongo_client():
+    """第一次使用時才建立 MongoClient；未設定 MONGO_URI 時拋出例外 (由各呼叫端的錯誤處理接住)"""
+    global _mongo_client
+    if _mongo_client is None:
+        with _mongo_client_lock:
+            if _mongo_client is None:
+                if not mongo_uri:
+                    raise RuntimeError("MONGO_URI is not set")
+                _mongo_client = MongoClient(
+                    mongo_uri,
+                    maxPoolSize=mongo_max_pool_size,
+                    minPoolSize=mongo_min_pool_size,
+                    serverSelectionTimeoutMS=mongo_timeout_ms,
+                    connectTimeoutMS=mongo_timeout_ms,
+                    appname="telegram-bot-summary",
+                )
+    return _mongo_client
+
+def get_mongo_db():
+    return get_mongo_client()[mongo_database_name]
+
+def close_mongo_client():
+    global _mongo_client
+    with _mongo_client_lock:
+        if _mongo_client is not None:
+            _mongo_client.close()
+            _mongo_client = None
+
+class LazyCollection:
+    """collection 代理：import 時不建立連線，第一次存取屬性時才透過 get_mongo_client() 連線"""
+
+    def __init__(self, name):
+        self.name = name
+
+    def __getattr__(self, attr):
+        return getattr(get_mongo_db()[self.name], attr)
+
+summary_collection = LazyCollection("summaries")
+summary_cache_collection = LazyCollection("summary_cache")
+transcript_collection = LazyCollection("transcripts")
+content_collection = LazyCollection("contents")  # 原始內容，以內容雜湊為 _id 壓縮保存
+job_collection = LazyCollection("summary_jobs")
+job_worker_collection = LazyCollection("summary_workers")  # 各 replica 的 worker 數，計算跨 replica 的通道容量
+
+# 摘要快取設定 (相同 URL + 語言 + 模型直接返回先前的摘要)
+enable_summary_cache = int(os.environ.get("ENABLE_SUMMARY_CACHE", 1))
+summary_cache_ttl = int(os.environ.get("SUMMARY_CACHE_TTL", 7 * 24 * 3600))  # 秒
+summary_cache_max_entries = int(os.environ.get("SUMMARY_CACHE_MAX_ENTRIES", 5000))
+
+# 摘要紀錄的背景寫入設定
+mongo_write_buffer_size = int(os.environ.get("MONGO_WRITE_BUFFER_SIZE", 1000))  # 緩衝區上限，滿了之後新的紀錄會被丟棄
+mongo_write_batch_size = int(os.environ.get("MONGO_WRITE_BATCH_SIZE", 50))  # 每次 insert_many 的最大筆數
+mongo_write_flush_interval = float(os.environ.get("MONGO_WRITE_FLUSH_INTERVAL", 1.0))  # 等待湊批次的最長秒數
+mongo_write_max_retries = 3
+
+class BufferedMongoWriter:
+    """
+    在背景執行緒以 insert_many 批次寫入 MongoDB，呼叫端只把文件放進有上限的緩衝區，
+    MongoDB 變慢或斷線時不會拖慢回覆；緩衝區滿時丟棄新文件並記錄在統計中
+    """
+
+    def __init__(self, collection, buffer_size, batch_size, flush_interval):
+        self.collection = collection
+        self.batch_size = batch_size
+        self.flush_interval = flush_interval
+        self._buffer = Queue(maxsize=buffer_size)
+        self._thread = None
+        self._lock = threading.Lock()  # 保護背景執行緒的啟動與 stats (event loop 與寫入執行緒都會更新)
+        self._stopping = threading.Event()
+        self.stats = {
+            "submitted": 0,
+            "written": 0,
+            "dropped": 0,
+            "failed": 0,
+            "batches": 0,
+            "max_depth": 0,
+            "last_batch_seconds": 0.0,
+        }
+
+    def _ensure_started(self):
+        with self._lock:
+            if self._thread is None:
+                self._thread = threading.Thread(target=self._run, name="mongo-writer", daemon=True)
+                self._thread.start()
+
+    def submit(self, document):
+        """放入緩衝區後立即返回 (不阻塞)；未設定 MONGO_URI 時不保存紀錄，直接略過"""
+        if not mongo_uri:
+            return False
+        self._ensure_started()
+        try:
+            self._buffer.put_nowait(document)
+        except Full:
+            with self._lock:
+                self.stats["dropped"] += 1
+            print(f"Mongo write buffer full, dropped document for {self.collection.name}")
+            return False
+        with self._lock:
+            self.stats["submitted"] += 1
+            self.stats["max_depth"] = max(self.stats["max_depth"], self._buffer.qsize())
+        return True
+
+    def depth(self):
+        return self._buffer.qsize()
+
+    def stats_snapshot(self):
+        with self._lock:
+            return dict(self.stats)
+
+    def _next_batch(self):
+        try:
+            batch = [self._buffer.get(timeout=self.flush_interval)]
+        except Empty:
+            return []
+        deadline = time.monotonic() + self.flush_interval
+        while len(batch) < self.batch_size:
+            remaining = deadline - time.monotonic()
+            if remaining <= 0 or self._stopping.is_set():
+                break
+            try:
+                batch.append(self._buffer.get(timeout=remaining))
+            except Empty:
+                break
+        return batch
+
+    def _write(self, batch):
+        for attempt in range(1, mongo_write_max_retries + 1):
+            start = time.monotonic()
+            try:
+                try:
+                    self.collection.insert_many(batch, ordered=False)
+                except BulkWriteError as e:
+                    # 部分寫入後重試時，已寫入的文件會得到 duplicate key 錯誤，表示資料已存在
+                    errors = e.details.get("writeErrors", [])
+                    if not errors or any(error.get("code") != 11000 for error in errors):
+                        raise
+                with self._lock:
+                    self.stats["written"] += len(batch)
+                    self.stats["batches"] += 1
+                    self.stats["last_batch_seconds"] = time.monotonic() - start
+                return
+            except Exception as e:
+                print(f"Error writing {len(batch)} documents to {self.collection.name} (attempt {attempt}): {e}")
+                if self._stopping.is_set():
+                    break
+                time.sleep(min(2 ** attempt, 30))
+        with self._lock:
+            self.stats["failed"] += len(batch)
+
+    def _run(self):
+        while not (self._stopping.is_set() and self._buffer.empty()):
+            batch = self._next_batch()
+            if batch:
+                self._write(batch)
+
+    def close(self, timeout=10):
+        """停止前盡量寫完緩衝區中的文件"""
+        self._stopping.set()
+        if self._thread is not None:
+            self._thread.join(timeout)
+
+summary_writer = BufferedMongoWriter(summary_collection, mongo_write_buffer_size, mongo_write_batch_size, mongo_write_flush_interval)
+
+def content_hash(text_array):
+    """原始內容 (段落列表) 的 SHA-256，相同內容只保存一份"""
+    return hashlib.sha256(json.dumps(text_array, ensure_ascii=False).encode('utf-8')).hexdigest()
+
+def compress_content(text_array):
+    """將段落列表序列化並壓縮，返回 (codec, bytes)"""
+    raw = json.dumps(text_array, ensure_ascii=False).encode('utf-8')
+    if zstandard is not None:
+        return "zstd", zstandard.ZstdCompressor(level=10).compress(raw)
+    return "zlib", zlib.compress(raw, 9)
+
+def decompress_content(codec, data):
+    if codec == "zstd":
+        if zstandard is None:
+            raise RuntimeError("zstandard is required to read zstd-compressed content")
+        raw = zstandard.ZstdDecompressor().decompress(data)
+    else:
+        raw = zlib.decompress(data)
+    return json.loads(raw.decode('utf-8'))
+
+def build_content_document(text_array):
+    """建立 contents collection 的文件 (壓縮是 CPU 工作，需在執行緒池中呼叫)"""
+    codec, data = compress_content(text_array)
+    return {
+        "_id": content_hash(text_array),
+        "codec": codec,
+        "data": data,
+        "paragraphs": len(text_array),
+        "raw_size": len(json.dumps(text_array, ensure_ascii=False).encode('utf-8')),
+        "compressed_size": len(data),
+        "created_at": datetime.now(),
+    }
+
+def store_content_document(content_document):
+    """同步寫入 contents collection (已存在時不覆寫)，引用 content_hash 的文件寫入前呼叫 (阻塞，需在執行緒池中呼叫)"""
+    content_collection.update_one({"_id": content_document["_id"]}, {"$setOnInsert": content_document}, upsert=True)
+
+def load_original_content(content_id):
+    """依內容雜湊讀回段落列表，不存在時返回 None (阻塞，需在執行緒池中呼叫)"""
+    document = content_collection.find_one({"_id": content_id})
+    if document is None:
+        return None
+    return decompress_content(document["codec"], document["data"])
+
+def ensure_ttl_index(collection, field, seconds):
+    """建立 TTL 索引；保存秒數改變時以 collMod 更新既有索引，而不是建立失敗"""
+    try:
+        collection.create_index(field, expireAfterSeconds=seconds)
+    except OperationFailure as e:
+        if e.code not in (85, 86):  # IndexOptionsConflict / IndexKeySpecsConflict
+            raise
+        get_mongo_db().command("collMod", collection.name, index={"keyPattern": {field: 1}, "expireAfterSeconds": seconds})
+
+def bootstrap_mongo_indexes():
+    """啟動時建立查詢用的索引，讓歷史查詢與快取查找不會做全表掃描 (阻塞，需在執行緒池中呼叫)"""
+    # 依用戶查詢摘要紀錄 (最新的在前)、依網址與內容雜湊查詢
+    summary_collection.create_index([("telegram_id", 1), ("timestamp", -1)])
+    summary_collection.create_index("url")
+    summary_collection.create_index("content_hash")
+    if summary_record_ttl:
+        ensure_ttl_index(summary_collection, "timestamp", summary_record_ttl)
+    _ensure_summary_cache_indexes()
+    # 轉錄結果寫入時帶有 expires_at，由 TTL monitor 刪除
+    ensure_ttl_index(transcript_collection, "expires_at", 0)
+    summary_job_queue._ensure_indexes()
+    print("MongoDB indexes ready")
 
 # 語言配置
 SUPPORTED_LANGUAGES = {
@@ -202,11 +575,477 @@ SYSTEM_PROMPT_EN = (
     "### ⓺ 【Hashtags】\nPlease extract 5 core concept hashtags based on the summary above. The format should be standard hashtags (e.g., \"#Tag1 #Tag2 #Tag3 #Tag4 #Tag5\"), ensuring all tags are in English and separated by a half-width space.\n\n"
 )
 
+# 分段摘要 (map 階段) 的 prompt：只整理重點筆記，六段式格式留給最後的 reduce 階段
+MAP_PROMPT_ZH = (
+    "以下是一份長篇內容的其中一段。請將這一段整理成條列式的重點筆記，使用繁體中文。"
+    "保留具體的論點、數據、人名與結論，不要加入開場白或結語，也不需要分成六個部分。"
+    "若內容為業配廣告或贊助商推廣，請直接略過。"
+)
+
+MAP_PROMPT_EN = (
+    "The following is one part of a longer piece of content. Condense this part into bullet-point notes in English. "
+    "Keep concrete arguments, figures, names and conclusions. Do not add an introduction or closing, and do not use the six-section format. "
+    "Skip any sponsored advertisements or promotions."
+)
+
+
+# 摘要結尾的機器人宣傳語
+SUMMARY_FOOTER = "\n\n✡ Oli小濃縮 Summary bot 為您濃縮重點 ✡"
+
+# Prompt 版本：prompt 內容變更時自動讓舊的摘要快取失效
+PROMPT_VERSION = hashlib.sha1((SYSTEM_PROMPT_ZH + SYSTEM_PROMPT_EN + MAP_PROMPT_ZH + MAP_PROMPT_EN + SUMMARY_FOOTER).encode('utf-8')).hexdigest()[:12]
+
+# 追蹤用、不影響內容的 query 參數
+TRACKING_QUERY_PARAMS = {'fbclid', 'gclid', 'igshid', 'si', 'feature', 'pp', 'ab_channel', 'ref', 'ref_src', 'spm', 'mc_cid', 'mc_eid'}
+
+def canonicalize_url(url):
+    """
+    將 URL 正規化，讓同一內容的不同寫法得到相同的 key：
+    統一 https、小寫主機並去掉 www./m.、移除追蹤參數與 fragment、排序 query，
+    YouTube 的 youtu.be / shorts / embed / live 連結統一成 youtube.com/watch?v=ID
+    """
+    url = url.strip()
+    if url.lower().startswith('www.'):
+        url = 'https://' + url
+    parts = urlsplit(url)
+    host = (parts.hostname or '').lower()
+    for prefix in ('www.', 'm.'):
+        if host.startswith(prefix):
+            host = host[len(prefix):]
+    if parts.port and parts.port not in (80, 443):
+        host = f"{host}:{parts.port}"
+    path = parts.path.rstrip('/') or '/'
+    query = [
+        (k, v) for k, v in parse_qsl(parts.query, keep_blank_values=True)
+        if k.lower() not in TRACKING_QUERY_PARAMS and not k.lower().startswith('utm_')
+    ]
+
+    if host == 'youtu.be':
+        host, path, query = 'youtube.com', '/watch', [('v', path.strip('/').split('/')[0])] + [(k, v) for k, v in query if k == 'list']
+    elif host in ('youtube.com', 'music.youtube.com'):
+        match = re.match(r'^/(shorts|embed|live)/([^/]+)', path)
+        if match:
+            path, query = '/watch', [('v', match.group(2))]
+        elif path == '/watch':
+            # 時間軸參數 t / start 不影響摘要內容
+            query = [(k, v) for k, v in query if k not in ('t', 'start', 'index')]
+
+    return urlunsplit(('https', host, path, urlencode(sorted(query)), ''))
+
+def summary_cache_key(url, language, selected_model):
+    """摘要快取的 key：正規化 URL + 語言 + 模型 + prompt 版本"""
+    raw = f"{canonicalize_url(url)}|{language}|{selected_model}|{PROMPT_VERSION}"
+    return hashlib.sha256(raw.encode('utf-8')).hexdigest()
+
+def is_valid_summary(summary):
+    """LLM 呼叫失敗時 summarize 只會返回錯誤訊息或空白加宣傳語，這些結果不應被快取"""
+    return bool(summary) and summary.strip() != SUMMARY_FOOTER.strip() and not summary.startswith("Unknown error!")
+
+_summary_cache_indexes_ready = False
+
+def _ensure_summary_cache_indexes():
+    global _summary_cache_indexes_ready
+    if _summary_cache_indexes_ready:
+        return
+    # expires_at 到期後由 MongoDB TTL monitor 自動刪除；last_used_at 用於容量滿時淘汰最久未使用的項目
+    summary_cache_collection.create_index("expires_at", expireAfterSeconds=0)
+    summary_cache_collection.create_index("last_used_at")
+    _summary_cache_indexes_ready = True
+
+def get_cached_summary(cache_key):
+    """查詢摘要快取，命中時更新使用時間並返回快取文件，否則返回 None (阻塞，需在執行緒池中呼叫)"""
+    if not enable_summary_cache:
+        return None
+    try:
+        now = datetime.now()
+        # TTL monitor 每分鐘才跑一次，過期但尚未刪除的項目視為未命中
+        return summary_cache_collection.find_one_and_update(
+            {"_id": cache_key, "expires_at": {"$gt": now}},
+            {"$set": {"last_used_at": now}, "$inc": {"hits": 1}},
+        )
+    except Exception as e:
+        print(f"Error reading summary cache: {e}")
+        return None
+
+def has_cached_summary(cache_key):
+    """只檢查摘要快取是否命中，不更新使用紀錄 (阻塞，需在執行緒池中呼叫)"""
+    if not enable_summary_cache:
+        return False
+    try:
+        return summary_cache_collection.find_one(
+            {"_id": cache_key, "expires_at": {"$gt": datetime.now()}}, {"_id": 1}
+        ) is not None
+    except Exception as e:
+        print(f"Error reading summary cache: {e}")
+        return False
+
+def load_cached_original_content(cached):
+    """讀回快取項目的原始內容；舊版快取內嵌 original_content，新版只保存 content_hash (阻塞)"""
+    if cached.get('original_content') is not None:
+        return cached['original_content']
+    if not cached.get('content_hash'):
+        return None
+    try:
+        return load_original_content(cached['content_hash'])
+    except Exception as e:
+        print(f"Error reading cached content: {e}")
+        return None
+
+def store_cached_summary(cache_key, url, language, selected_model, title, summary, text_array):
+    """
+    寫入摘要快取，超過 SUMMARY_CACHE_MAX_ENTRIES 時淘汰最久未使用的項目 (阻塞，需在執行緒池中呼叫)
+    原始內容壓縮後存在 contents collection，快取只保存 content_hash；
+    內容在此同步寫入 (不經過背景寫入)，快取命中時一定讀得到
+    """
+    if not enable_summary_cache or not is_valid_summary(summary):
+        return
+    try:
+        _ensure_summary_cache_indexes()
+        content_document = build_content_document(text_array)
+        store_content_document(content_document)
+        now = datetime.now()
+        summary_cache_collection.replace_one(
+            {"_id": cache_key},
+            {
+                "_id": cache_key,
+                "url": canonicalize_url(url),
+                "language": language,
+                "model": selected_model,
+                "prompt_version": PROMPT_VERSION,
+                "title": title,
+                "summary": summary,
+                "content_hash": content_document["_id"],
+                "hits": 0,
+                "created_at": now,
+                "last_used_at": now,
+                "expires_at": now + timedelta(seconds=summary_cache_ttl),
+            },
+            upsert=True,
+        )
+
+        overflow = summary_cache_collection.estimated_document_count() - summary_cache_max_entries
+        if overflow > 0:
+            stale_ids = [
+                doc["_id"] for doc in
+                summary_cache_collection.find({}, {"_id": 1}).sort("last_used_at", 1).limit(overflow)
+            ]
+            summary_cache_collection.delete_many({"_id": {"$in": stale_ids}})
+    except Exception as e:
+        print(f"Error writing summary cache: {e}")
+
+
+# 中日韓文字 (含全形標點)，這類字元大約一字一個 token，且字詞之間沒有空白
+CJK_CHAR_PATTERN = re.compile(r'[\u3000-\u303f\u3040-\u30ff\u3400-\u4dbf\u4e00-\u9fff\uf900-\ufaff\uff00-\uffef\uac00-\ud7af]')
+
+def estimate_tokens(text):
+    """
+    快速估計 token 數，不需載入 tokenizer：
+    中日韓字元約 1 token / 字，其他文字約 4 字元 / token
+    """
+    cjk_count = len(CJK_CHAR_PATTERN.findall(text))
+    return int(math.ceil(cjk_count + (len(text) - cjk_count) / 4))
+
+def _token_weight(text):
+    """estimate_tokens 的可加總版本 (不取整)，讓分段時可以逐段累加"""
+    cjk_count = len(CJK_CHAR_PATTERN.findall(text))
+    return cjk_count + (len(text) - cjk_count) / 4
+
+# 分段時依序嘗試的邊界：段落 → 換行 → 句子 (含中文句末標點) → 子句 (逗號、頓號) → 空白
+# 每個 pattern 都用 capturing group，re.split 會保留分隔符，接回前一段後即可無損還原原文
+CHUNK_BOUNDARY_PATTERNS = [
+    re.compile(r'(\n\s*\n)'),
+    re.compile(r'(\n)'),
+    re.compile(r'((?:[。！？；…]+[」』”’）)]*|[.!?;]+["\'”’)\]]*(?=\s|$))[ \t]*)'),
+    re.compile(r'([，、,：:][ \t]*)'),
+    re.compile(r'(\s+)'),
+]
+
+def _split_keep_separators(text, pattern):
+    parts = pattern.split(text)
+    # parts 依序為 [文字, 分隔符, 文字, 分隔符, ..., 文字]
+    segments = [parts[i] + parts[i + 1] for i in range(0, len(parts) - 1, 2)]
+    segments.append(parts[-1])
+    return [segment for segment in segments if segment]
+
+def _hard_split(text, max_size, measure):
+    """沒有任何邊界可用時 (例如沒有標點的長串中文)，依大小直接切開"""
+    pieces = []
+    start = 0
+    size = 0
+    for i, char in enumerate(text):
+        char_size = measure(char)
+        if size + char_size > max_size and i > start:
+            pieces.append(text[start:i])
+            start, size = i, 0
+        size += char_size
+    if start < len(text):
+        pieces.append(text[start:])
+    return pieces
+
+def _chunk_segments(text, max_size, measure, level):
+    if level >= len(CHUNK_BOUNDARY_PATTERNS):
+        segments = _hard_split(text, max_size, measure)
+    else:
+        segments = _split_keep_separators(text, CHUNK_BOUNDARY_PATTERNS[level])
+
+    chunks = []
+    current = []
+    current_size = 0
+
+    def flush():
+        if current:
+            chunk = "".join(current).strip()
+            if chunk:
+                chunks.append(chunk)
+            current.clear()
+
+    for segment in segments:
+        size = measure(segment)
+        if size > max_size and level < len(CHUNK_BOUNDARY_PATTERNS):
+            # 這一段本身就超過上限，改用更細的邊界切
+            flush()
+            current_size = 0
+            chunks.extend(_chunk_segments(segment, max_size, measure, level + 1))
+            continue
+        if current and current_size + size > max_size:
+            flush()
+            current_size = 0
+        current.append(segment)
+        current_size += size
+    flush()
+    return chunks
+
+def chunk_text(text, max_size=None, unit=None):
+    """
+    將長文字切成不超過 max_size 的段落列表，所有擷取路徑 (字幕、音頻轉錄、podcast) 共用
+    - 優先在段落、換行、句子 (含 。！？ 等中文標點)、子句、空白處切開，都沒有時才硬切
+    - unit='chars' 以字元數計算，unit='tokens' 以 estimate_tokens 估計的 token 數計算
+    - 每個字元只會被處理常數次，時間複雜度為線性
+    """
+    max_size = max_size or chunk_size
+    unit = unit or chunk_unit
+    measure = _token_weight if unit == 'tokens' else len
+    if not text or not text.strip():
+        return []
+    return _chunk_segments(text, max_size, measure, 0)
+
+# 模型的 (context window, 最大輸出) token 數，以模型名稱前綴比對，較長的前綴優先
+# 可用 LLM_CONTEXT_TOKENS / LLM_MAX_OUTPUT_TOKENS (LLM2_ 同理) 覆寫目前設定模型的數值
+MODEL_TOKEN_LIMITS = {
+    "gpt-3.5-turbo": (16385, 4096),
+    "gpt-4-turbo": (128000, 4096),
+    "gpt-4o": (128000, 16384),
+    "chatgpt-4o": (128000, 16384),
+    "gpt-4.1": (1047576, 32768),
+    "gpt-5": (400000, 128000),
+    "o1": (200000, 100000),
+    "o3": (200000, 100000),
+    "o4-mini": (200000, 100000),
+    "gemini-": (1048576, 8192),
+    "gemini-2.5": (1048576, 65536),
+    "claude-": (200000, 8192),
+    "llama-3.1": (128000, 8192),
+    "llama-3.3": (128000, 8192),
+    "deepseek": (64000, 8192),
+    "qwen": (32768, 8192),
+    "grok": (131072, 8192),
+}
+DEFAULT_MODEL_TOKEN_LIMITS = (32768, 4096)  # 未知模型採保守值
+
+token_safety_margin = float(os.environ.get("TOKEN_SAFETY_MARGIN", 0.1))  # 預留給 token 估計誤差的比例
+
+def _env_token_limits(prefix):
+    context_tokens = os.environ.get(f"{prefix}_CONTEXT_TOKENS")
+    output_tokens = os.environ.get(f"{prefix}_MAX_OUTPUT_TOKENS")
+    return (int(context_tokens) if context_tokens else None, int(output_tokens) if output_tokens else None)
+
+model_token_limit_overrides = {}
+for _prefix, _model_name in (("LLM2", llm2_model), ("LLM", model)):
+    if _model_name:
+        model_token_limit_overrides[_model_name] = _env_token_limits(_prefix)
+
+def get_model_token_limits(model_name):
+    """返回模型的 (context window, 最大輸出) token 數"""
+    name = (model_name or model).split("/")[-1].lower()  # 去掉 openrouter / litellm 的 provider 前綴
+    limits = DEFAULT_MODEL_TOKEN_LIMITS
+    matched = ""
+    for prefix, prefix_limits in MODEL_TOKEN_LIMITS.items():
+        if name.startswith(prefix) and len(prefix) > len(matched):
+            limits, matched = prefix_limits, prefix
+    context_override, output_override = model_token_limit_overrides.get(model_name or model, (None, None))
+    return (context_override or limits[0], output_override or limits[1])
+
+def input_token_budget(model_name):
+    """一次請求可用的輸入 token 數：context window 扣掉輸出保留量與估計誤差"""
+    context_tokens, output_tokens = get_model_token_limits(model_name)
+    return int((context_tokens - output_tokens) * (1 - token_safety_margin))
+
+def estimate_messages_tokens(messages):
+    # 每則訊息另計約 4 個 token 的角色與格式開銷
+    return sum(estimate_tokens(message.get("content") or "") + 4 for message in messages)
+
+def truncate_to_tokens(text, max_tokens):
+    """截斷文字使估計 token 數不超過 max_tokens (二分搜尋截斷位置)"""
+    if max_tokens <= 0:
+        return ""
+    if estimate_tokens(text) <= max_tokens:
+        return text
+    low, high = 0, len(text)
+    while low < high:
+        middle = (low + high + 1) // 2
+        if estimate_tokens(text[:middle]) <= max_tokens:
+            low = middle
+        else:
+            high = middle - 1
+    return text[:low]
+
+token_usage_stats = {"requests": 0, "estimated_input_tokens": 0, "reported_prompt_tokens": 0, "trimmed_requests": 0}
+
+def fit_messages_to_budget(messages, model_name):
+    """
+    發送前檢查請求是否超過模型的輸入預算，超過時從最長的訊息尾端截斷，
+    避免等到 API 回傳 context length 錯誤才發現
+    """
+    budget = input_token_budget(model_name)
+    total = estimate_messages_tokens(messages)
+    token_usage_stats["requests"] += 1
+    if total <= budget:
+        token_usage_stats["estimated_input_tokens"] += total
+        return messages
+
+    print(f"Warning: request for {model_name} is ~{total} tokens, over the {budget} token budget; trimming")
+    token_usage_stats["trimmed_requests"] += 1
+    messages = [dict(message) for message in messages]
+    while total > budget:
+        longest = max(messages, key=lambda message: estimate_tokens(message.get("content") or ""))
+        content = longest.get("content") or ""
+        content_tokens = estimate_tokens(content)
+        if content_tokens == 0:
+            break
+        longest["content"] = truncate_to_tokens(content, max(content_tokens - (total - budget), 0))
+        total = estimate_messages_tokens(messages)
+    token_usage_stats["estimated_input_tokens"] += total
+    return messages
+
+# 續問檢索設定：摘要完成時將原始內容切成以句子為邊界的短段落並建立 BM25 索引，
+# 續問時只送出與問題最相關的段落
+followup_passage_tokens = int(os.environ.get("FOLLOWUP_PASSAGE_TOKENS", 150))  # 每個檢索段落的估計 token 數
+followup_top_k = int(os.environ.get("FOLLOWUP_TOP_K", 8))  # 續問時最多附上的段落數
+bm25_index_cache_size = int(os.environ.get("BM25_INDEX_CACHE_SIZE", 128))  # 記憶體中保留的索引數
+
+# 檢索用的中日韓文字範圍 (假名、漢字、韓文，不含全形標點)
+SEARCH_CJK_RANGE = r'\u3040-\u30ff\u3400-\u4dbf\u4e00-\u9fff\uf900-\ufaff\uac00-\ud7af'
+SEARCH_TOKEN_PATTERN = re.compile(r'[a-z0-9]+|[' + SEARCH_CJK_RANGE + r']+')
+CJK_RUN_PATTERN = re.compile(r'[' + SEARCH_CJK_RANGE + r']')
+
+def tokenize_for_search(text):
+    """
+    檢索用的斷詞：英數字以單字為單位，中日韓文字沒有空白分詞，改用相鄰兩字 (bigram)
+    例如「語言模型」→ 語言、言模、模型
+    """
+    tokens = []
+    for run in SEARCH_TOKEN_PATTERN.findall(text.lower()):
+        if CJK_RUN_PATTERN.match(run):
+            if len(run) == 1:
+                tokens.append(run)
+            else:
+                tokens.extend(run[i:i + 2] for i in range(len(run) - 1))
+        else:
+            tokens.append(run)
+    return tokens
+
+class BM25Index:
+    """Okapi BM25 索引，文件為續問檢索用的段落"""
+
+    def __init__(self, passages, k1=1.5, b=0.75):
+        self.k1 = k1
+        self.b = b
+        self.term_frequencies = []
+        self.lengths = []
+        document_frequencies = {}
+        for passage in passages:
+            frequencies = {}
+            tokens = tokenize_for_search(passage)
+            for token in tokens:
+                frequencies[token] = frequencies.get(token, 0) + 1
+            for token in frequencies:
+                document_frequencies[token] = document_frequencies.get(token, 0) + 1
+            self.term_frequencies.append(frequencies)
+            self.lengths.append(len(tokens))
+        count = len(passages)
+        self.average_length = (sum(self.lengths) / count) if count else 0
+        self.idf = {
+            token: math.log(1 + (count - frequency + 0.5) / (frequency + 0.5))
+            for token, frequency in document_frequencies.items()
+        }
+
+    def search(self, query, top_k):
+        """返回 [(分數, 段落索引), ...]，依分數由高到低，只包含分數大於 0 的段落"""
+        query_tokens = [token for token in set(tokenize_for_search(query)) if token in self.idf]
+        if not query_tokens:
+            return []
+        scores = []
+        for index, frequencies in enumerate(self.term_frequencies):
+            length_norm = self.k1 * (1 - self.b + self.b * self.lengths[index] / (self.average_length or 1))
+            score = 0.0
+            for token in query_tokens:
+                frequency = frequencies.get(token)
+                if frequency:
+                    score += self.idf[token] * frequency * (self.k1 + 1) / (frequency + length_norm)
+            if score > 0:
+                scores.append((score, index))
+        scores.sort(reverse=True)
+        return scores[:top_k]
+
+_bm25_index_cache = OrderedDict()
+_bm25_index_cache_lock = threading.Lock()
+
+def build_passages(text_array, max_chars):
+    """將原始內容切成檢索用的短段落 (優先在句子邊界切開)，總長度不超過 max_chars"""
+    passages = []
+    remaining = max_chars
+    for passage in chunk_text("\n".join(text_array), followup_passage_tokens, "tokens"):
+        if remaining <= 0:
+            break
+        passages.append(passage[:remaining])
+        remaining -= len(passage)
+    return passages
+
+def get_passage_index(content_id, passages):
+    """取得段落的 BM25 索引；快取中沒有時 (重啟後、其他 replica 建立的對話) 重新建立 (CPU 工作，需在執行緒池中呼叫)"""
+    with _bm25_index_cache_lock:
+        index = _bm25_index_cache.get(content_id)
+        if index is not None:
+            _bm25_index_cache.move_to_end(content_id)
+            return index
+    index = BM25Index(passages)
+    with _bm25_index_cache_lock:
+        _bm25_index_cache[content_id] = index
+        while len(_bm25_index_cache) > bm25_index_cache_size:
+            _bm25_index_cache.popitem(last=False)
+    return index
+
+def select_passages(content_id, passages, query, max_tokens, top_k=None):
+    """
+    檢索與問題最相關的段落，依分數挑選直到用完 max_tokens，再依原文順序返回
+    問題與內容沒有共同詞彙時，退回使用開頭的段落
+    """
+    index = get_passage_index(content_id, passages)
+    ranked = [position for _, position in index.search(query, top_k or followup_top_k)]
+    if not ranked:
+        ranked = list(range(min(len(passages), top_k or followup_top_k)))
+    selected = []
+    used = 0
+    for position in ranked:
+        cost = estimate_tokens(passages[position]) + 2
+        if used + cost > max_tokens:
+            continue
+        selected.append(position)
+        used += cost
+    return [passages[position] for position in sorted(selected)]
 
 def split_user_input(text):
-    paragraphs = text.split('\n')
-    paragraphs = [paragraph.strip() for paragraph in paragraphs if paragraph.strip()]
-    return paragraphs
+    return chunk_text(text)
 
 def scrape_text_from_url(url):
     try:
@@ -218,8 +1057,7 @@ def scrape_text_from_url(url):
         if text is None or text.strip() == "":
             return [], "提取的內容為空，可能該網站不支持解析。"  # 返回兩個值：空內容和錯誤消息
         
-        text_chunks = text.split("\n")
-        article_content = [chunk.strip() for chunk in text_chunks if chunk.strip()]
+        article_content = chunk_text(text)
         
         if not article_content:
             return [], "提取的內容為空。"  # 返回兩個值：空內容和錯誤消息
@@ -230,7 +1068,67 @@ def scrape_text_from_url(url):
         return [], f"抓取過程中發生錯誤：{str(e)}"  # 返回兩個值：空內容和錯誤信息
 
 
-def summarize(text_array, language='zh-TW', selected_model=None):
+# system prompt 與附加說明約佔的 token 數，計算輸入預算時先扣除
+PROMPT_OVERHEAD_TOKENS = max(estimate_tokens(prompt) for prompt in (SYSTEM_PROMPT_ZH, SYSTEM_PROMPT_EN, MAP_PROMPT_ZH, MAP_PROMPT_EN)) + 64
+
+def get_map_reduce_settings(model_name):
+    """取得指定模型的分段摘要設定 (threshold / chunk_tokens / fan_out)，未設定的欄位使用全域預設值"""
+    settings = {
+        "threshold": map_reduce_threshold_tokens,
+        "chunk_tokens": map_reduce_chunk_tokens,
+        "fan_out": map_reduce_fan_out,
+    }
+    settings.update(map_reduce_model_settings.get(model_name, {}))
+    # 門檻與每段大小不能超過模型的輸入預算 (需扣掉 system prompt)
+    budget = input_token_budget(model_name) - PROMPT_OVERHEAD_TOKENS
+    settings["threshold"] = min(settings["threshold"], budget)
+    settings["chunk_tokens"] = min(settings["chunk_tokens"], budget)
+    return settings
+
+async def map_summarize(full_text, language='zh-TW', selected_model=None):
+    """
+    分段摘要：文本超過模型的門檻時，切成多段並行整理成重點筆記，返回合併後的筆記
+    筆記仍超過門檻時再整理一輪 (階層式)，直到可以一次放進 reduce 階段；
+    最多 MAP_REDUCE_MAX_ROUNDS 輪，筆記沒有變短就提早停止，之後仍超過門檻的部分截斷
+    """
+    settings = get_map_reduce_settings(selected_model or model)
+    map_prompt = MAP_PROMPT_EN if language == 'en' else MAP_PROMPT_ZH
+    semaphore = asyncio.Semaphore(settings["fan_out"])
+
+    async def summarize_part(index, total, part):
+        async with semaphore:
+            print(f"Map summarizing part {index+1}/{total} (~{estimate_tokens(part)} tokens)")
+            notes = await call_gpt_api(
+                f"Part {index+1}/{total}:\n" + part,
+                [{"role": "system", "content": map_prompt}],
+                selected_model=selected_model,
+            )
+            return notes
+
+    rounds = 0
+    while estimate_tokens(full_text) > settings["threshold"]:
+        if rounds >= map_reduce_max_rounds:
+            print(f"Warning: notes still ~{estimate_tokens(full_text)} tokens after {rounds} map rounds, truncating")
+            return truncate_to_tokens(full_text, settings["threshold"])
+        rounds += 1
+        parts = chunk_text(full_text, settings["chunk_tokens"], "tokens")
+        if len(parts) <= 1:
+            break
+        notes = await asyncio.gather(*(summarize_part(i, len(parts), part) for i, part in enumerate(parts)))
+        notes = [note for note in notes if note]
+        if not notes:
+            raise RuntimeError("All map summaries failed")
+        if len(notes) < len(parts):
+            print(f"Warning: {len(parts) - len(notes)}/{len(parts)} map summaries failed")
+        previous_tokens = estimate_tokens(full_text)
+        full_text = "\n\n".join(notes)
+        if estimate_tokens(full_text) >= previous_tokens:
+            # 模型輸出沒有變短，再整理也不會收斂
+            print(f"Warning: map round {rounds} did not shrink the notes, truncating")
+            return truncate_to_tokens(full_text, settings["threshold"])
+    return full_text
+
+async def summarize(text_array, language='zh-TW', selected_model=None, on_delta=None):
     try:
         # 將所有段落合併成一個完整的文本
         full_text = "\n".join(text_array)
@@ -248,11 +1146,15 @@ def summarize(text_array, language='zh-TW', selected_model=None):
             }
         ]
         
-        # 建構 prompt，直接附上整個文本
+        # 長文先分段整理成筆記 (map)，再由筆記產生六段式摘要 (reduce)；短文直接一次摘要
+        if estimate_tokens(full_text) > get_map_reduce_settings(selected_model or model)["threshold"]:
+            full_text = await map_summarize(full_text, language=language, selected_model=selected_model)
+
+        # 建構 prompt，附上整個文本
         prompt = "總結 the following text:\n" + full_text
         
         # 呼叫 GPT API 生成摘要
-        summary = call_gpt_api(prompt, system_messages, selected_model=selected_model)
+        summary = await call_gpt_api(prompt, system_messages, selected_model=selected_model, on_delta=on_delta)
 
         # 針對 Hashtag 進行跳脫處理，避免被 Markdown 引擎誤判為 H1 標題
         # (將前方為空白或行首，且後方不為空白與 # 的 # 替換為 \#)
@@ -260,77 +1162,580 @@ def summarize(text_array, language='zh-TW', selected_model=None):
             summary = re.sub(r'(?<!\S)#(?=[^\s#])', r'\#', summary)
 
         # 加入機器人宣傳語
-        summary += "\n\n✡ Oli小濃縮 Summary bot 為您濃縮重點 ✡"
+        summary += SUMMARY_FOOTER
 
         return summary
     except Exception as e:
         print(f"Error: {e}")
         return "Unknown error! Please contact the owner. ok@vip.david888.com"
 
+# Markdown → Telegram HTML：單次逐行掃描區塊、單一正則處理行內語法，沿用舊版 (markdown + BeautifulSoup) 的輸出格式
+TELEGRAM_HEADING_PATTERN = re.compile(r'^ {0,3}(#{1,6})[ \t]*(.*?)[ \t]*#*[ \t]*$')
+TELEGRAM_SETEXT_PATTERN = re.compile(r'^ {0,3}(=+|-+)[ \t]*$')
+TELEGRAM_HR_PATTERN = re.compile(r'^ {0,3}([-*_])(?:[ \t]*\1){2,}[ \t]*$')
+TELEGRAM_LIST_PATTERN = re.compile(r'^( *)(?:[-*+]|\d+\.)[ \t]+(.*)$')
+TELEGRAM_QUOTE_PATTERN = re.compile(r'^ {0,3}> ?(.*)$')
+TELEGRAM_HARD_BREAK_PATTERN = re.compile(r' {2,}\n')
+TELEGRAM_ENTITY_PATTERN = re.compile(r'&(?!#?\w+;)')
+TELEGRAM_INLINE_PATTERN = re.compile(
+    r'\\(?P<escape>[\\`*_{}\[\]()>#+\-.!])'
+    r'|(?P<ticks>`+)(?P<code>.+?)(?P=ticks)'
+    r'|!\[[^\]]*\]\([^)]*\)'
+    r'|\[(?P<link>[^\]]+)\]\([^)]*\)'
+    r'|<(?P<url>(?:https?|ftp)://[^>\s]+)>'
+    r'|(?P<strong_em_mark>\*\*\*|___)(?=\S)(?P<strong_em>.+?)(?<=\S)(?P=strong_em_mark)'
+    r'|(?P<strong_mark>\*\*|__)(?=\S)(?P<strong>.+?)(?<=\S)(?P=strong_mark)'
+    r'|\*(?=\S)(?P<em>.+?)(?<=\S)\*'
+    r'|(?<!\w)_(?=\S)(?P<em_underscore>.+?)(?<=\S)_(?!\w)',
+    re.DOTALL,
+)
+
+def escape_telegram_html(text):
+    """跳脫 Telegram HTML 模式的 <, >, &，保留原文中已是實體的 &amp; 等"""
+    return TELEGRAM_ENTITY_PATTERN.sub('&amp;', text).replace('<', '&lt;').replace('>', '&gt;')
+
+def render_telegram_inline(text):
+    """行內 Markdown 轉為已跳脫的純文字：粗體、斜體、程式碼、連結只保留文字，圖片移除；***粗斜體*** 轉為 <b><i>"""
+    parts = []
+    position = 0
+    for match in TELEGRAM_INLINE_PATTERN.finditer(text):
+        parts.append(escape_telegram_html(text[position:match.start()]))
+        position = match.end()
+        if match.group('escape') is not None:
+            parts.append(escape_telegram_html(match.group('escape')))
+        elif match.group('code') is not None:
+            parts.append(html_lib.escape(match.group('code').strip(), quote=False))
+        elif match.group('url') is not None:
+            parts.append(escape_telegram_html(match.group('url')))
+        elif match.group('strong_em') is not None:
+            parts.append(f"<b><i>{render_telegram_inline(match.group('strong_em'))}</i></b>")
+        else:
+            inner = match.group('link') or match.group('strong') or match.group('em') or match.group('em_underscore')
+            if inner:
+                parts.append(render_telegram_inline(inner))
+    parts.append(escape_telegram_html(text[position:]))
+    return ''.join(parts)
+
+def _render_telegram_paragraph(lines):
+    text = TELEGRAM_HARD_BREAK_PATTERN.sub('\n', '\n'.join(lines).strip())
+    return render_telegram_inline(text)
+
+def _interrupts_paragraph(line):
+    return bool(TELEGRAM_HEADING_PATTERN.match(line) and line.lstrip().startswith('#')) \
+        or bool(TELEGRAM_HR_PATTERN.match(line)) or bool(TELEGRAM_QUOTE_PATTERN.match(line))
+
+def _render_telegram_blocks(lines):
+    blocks = []
+    i = 0
+    count = len(lines)
+    while i < count:
+        line = lines[i]
+        if not line.strip():
+            i += 1
+            continue
+
+        heading = TELEGRAM_HEADING_PATTERN.match(line) if line.lstrip().startswith('#') else None
+        if heading:
+            blocks.append(f"<b>{render_telegram_inline(heading.group(2))}</b>\n\n")
+            i += 1
+            continue
+
+        if TELEGRAM_HR_PATTERN.match(line):
+            blocks.append("\n----------\n")
+            i += 1
+            continue
+
+        if line.startswith('    ') or line.startswith('\t'):
+            code_lines = []
+            while i < count and (not lines[i].strip() or lines[i].startswith('    ') or lines[i].startswith('\t')):
+                code_lines.append(lines[i][4:] if lines[i].startswith('    ') else lines[i][1:])
+                i += 1
+            code = '\n'.join(code_lines).rstrip('\n')
+            blocks.append(f"<pre><code>{html_lib.escape(code, quote=False)}\n</code></pre>")
+            continue
+
+        if TELEGRAM_QUOTE_PATTERN.match(line):
+            quote_lines = []
+            while i < count and lines[i].strip():
+                quote = TELEGRAM_QUOTE_PATTERN.match(lines[i])
+                quote_lines.append(quote.group(1) if quote else lines[i])
+                i += 1
+            inner = '\n'.join(_render_telegram_blocks(quote_lines))
+            blocks.append(f"<blockquote>\n{inner}\n</blockquote>")
+            continue
+
+        if TELEGRAM_LIST_PATTERN.match(line):
+            items = []
+            while i < count:
+                line = lines[i]
+                item = TELEGRAM_LIST_PATTERN.match(line) if not TELEGRAM_HR_PATTERN.match(line) else None
+                if item:
+                    items.append((len(item.group(1)) // 4, [item.group(2)]))
+                elif not line.strip():
+                    # 空行後若接著清單項或縮排內容，仍屬同一個清單
+                    following = i + 1
+                    while following < count and not lines[following].strip():
+                        following += 1
+                    if following < count and (lines[following].startswith('    ')
+                                              or (TELEGRAM_LIST_PATTERN.match(lines[following])
+                                                  and not TELEGRAM_HR_PATTERN.match(lines[following]))):
+                        i = following
+                        continue
+                    break
+                elif _interrupts_paragraph(line) and not line.startswith('    '):
+                    break
+                else:
+                    items[-1][1].append(line.rstrip())
+                i += 1
+            rendered = [f"{'    ' * level}• {_render_telegram_paragraph(item_lines)}\n" for level, item_lines in items]
+            blocks.append("\n" + "\n".join(rendered) + "\n")
+            continue
+
+        if i + 1 < count and TELEGRAM_SETEXT_PATTERN.match(lines[i + 1]):
+            blocks.append(f"<b>{render_telegram_inline(line.strip())}</b>\n\n")
+            i += 2
+            continue
+
+        paragraph = [line]
+        i += 1
+        while i < count and lines[i].strip() and not _interrupts_paragraph(lines[i]):
+            paragraph.append(lines[i])
+            i += 1
+        blocks.append(f"{_render_telegram_paragraph(paragraph)}\n\n")
+    return blocks
+
 def format_for_telegram(markdown_text):
     """
     將 Markdown 轉換成 Telegram 支援的有限 HTML 標籤
-    Telegram 僅支援 <b>, <i>, <u>, <s>, <a>, <code>, <pre>, <tg-spoiler> 等
-    不支援 <h1>~<h6>, <ul>, <li>, <p>, <br> 等標準 HTML
+    Telegram 僅支援 <b>, <i>, <u>, <s>, <a>, <code>, <pre>, <blockquote> 等
+    不支援 <h1>~<h6>, <ul>, <li>, <p>, <br> 等標準 HTML：標題轉為粗體、清單轉為 • 項目、分隔線轉為文字，
+    其餘文字中的 <, >, & 一律跳脫，避免 Telegram 因無效 HTML 拒收訊息
     """
     if not markdown_text:
         return markdown_text
-        
+
     try:
-        # 1. 將 Markdown 轉成完整 HTML
-        html = markdown.markdown(markdown_text, extensions=['nl2br'])
-        
-        # 2. 使用 BeautifulSoup 進行標籤轉換與過濾
-        soup = BeautifulSoup(html, 'html.parser')
-        
-        # 把標題 (<h1>~<h6>) 轉換為粗體並加換行
-        for v in soup.find_all(['h1', 'h2', 'h3', 'h4', 'h5', 'h6']):
-            new_text = f"<b>{v.get_text()}</b>\n\n"
-            v.replace_with(new_text)
-            
-        # 把清單項 (<li>) 轉換為帶有 bullet point 的文字
-        for li in soup.find_all('li'):
-            li.replace_with(f"• {li.get_text()}\n")
-            
-        # 移除 <ul> 和 <ol> 的外層包裹
-        for ul in soup.find_all(['ul', 'ol']):
-            ul.unwrap()
-            
-        # 把 <p> 轉換成帶有換行的純文字
-        for p in soup.find_all('p'):
-            p.replace_with(f"{p.get_text()}\n\n")
-            
-        # 把 <br> 替換為實際的換行符號
-        for br in soup.find_all('br'):
-            br.replace_with("\n")
-            
-        # 把 <hr> 替換為分隔線文字
-        for hr in soup.find_all('hr'):
-            hr.replace_with("\n----------\n")
-            
-        # 把 <strong> 轉換為 <b>
-        for strong in soup.find_all('strong'):
-            strong.name = 'b'
-            
-        # 把 <em> 轉換為 <i>
-        for em in soup.find_all('em'):
-            em.name = 'i'
-            
-        # 取得純文字並只保留 Telegram 允許的標籤
-        final_text = str(soup)
-        
-        # html.parser 的 unwrap 跟 replace_with 可能會留下多餘的全形空白或疊加換行，簡單清理
+        lines = markdown_text.replace('\r\n', '\n').replace('\r', '\n').split('\n')
+        final_text = '\n'.join(_render_telegram_blocks(lines))
         final_text = re.sub(r'\n{3,}', '\n\n', final_text)
-        # unescape 避免 &amp; 等實體在 Telegram 中顯示異常（雖然 Telegram HTML mode 有些自動處理，但清乾淨比較保險）
-        import html as html_lib
-        final_text = html_lib.unescape(final_text)
-        
         return final_text.strip()
     except Exception as e:
         print(f"Error formatting for Telegram: {e}")
         return markdown_text # 如果轉換失敗，退回原始文字
 
+TELEGRAM_MESSAGE_LIMIT = 4096  # Telegram 單則訊息上限，以解析標籤後的文字 UTF-16 長度計算
+
+TELEGRAM_HTML_TOKEN_PATTERN = re.compile(r'<(/?)([a-zA-Z][\w-]*)[^>]*>|&(?:#\d+|#x[0-9a-fA-F]+|\w+);|[^<&]+|[<&]')
+# 文字依分隔符切成小片段，每段結尾帶著自己的分隔符 (空行、換行、句尾標點、空白)
+TELEGRAM_TEXT_PIECE_PATTERN = re.compile(r'[^\n。！？!?.\s]*(?:\n+|[。！？!?.]+[^\S\n]*|[^\S\n]+)|[^\n。！？!?.\s]+')
+# 分段位置的優先順序：章節 (空行後接標題或分隔線) > 段落 > 換行 > 句子 > 空白 > 任意位置
+TELEGRAM_SPLIT_SECTION, TELEGRAM_SPLIT_PARAGRAPH, TELEGRAM_SPLIT_LINE, TELEGRAM_SPLIT_SENTENCE, TELEGRAM_SPLIT_SPACE, TELEGRAM_SPLIT_ANY = range(6)
+
+def telegram_text_length(text):
+    """Telegram 計算長度的方式：UTF-16 code units (emoji 等 BMP 以外的字元算 2)"""
+    return len(text.encode('utf-16-le')) // 2
+
+def telegram_text_tail(text, limit):
+    """返回 text 結尾不超過 limit 個 UTF-16 code units 的部分，不會切開 surrogate pair"""
+    encoded = text.encode('utf-16-le')
+    if len(encoded) // 2 <= limit:
+        return text
+    tail = encoded[-limit * 2:]
+    if 0xDC00 <= int.from_bytes(tail[:2], 'little') <= 0xDFFF:
+        tail = tail[2:]  # 開頭是半個 emoji (低位 surrogate)，捨棄
+    return tail.decode('utf-16-le')
+
+def _telegram_split_level(text):
+    if text.endswith('\n\n'):
+        return TELEGRAM_SPLIT_PARAGRAPH
+    if text.endswith('\n'):
+        return TELEGRAM_SPLIT_LINE
+    stripped = text.rstrip()
+    if stripped and stripped[-1] in '。！？!?.':
+        return TELEGRAM_SPLIT_SENTENCE
+    if stripped != text:
+        return TELEGRAM_SPLIT_SPACE
+    return TELEGRAM_SPLIT_ANY
+
+def _tokenize_telegram_html(html_text, max_piece):
+    """把 HTML 拆成 (片段, 可見長度, 開啟標籤, 關閉標籤名, 片段後的分段等級)，標籤與實體不會被切開"""
+    tokens = []
+    for match in TELEGRAM_HTML_TOKEN_PATTERN.finditer(html_text):
+        fragment = match.group(0)
+        if match.group(2):
+            if match.group(1):
+                tokens.append((fragment, 0, None, match.group(2).lower(), TELEGRAM_SPLIT_ANY))
+            else:
+                tokens.append((fragment, 0, fragment, match.group(2).lower(), TELEGRAM_SPLIT_ANY))
+        elif fragment.startswith('&') and len(fragment) > 1:
+            tokens.append((fragment, 1, None, None, TELEGRAM_SPLIT_ANY))
+        else:
+            for piece in TELEGRAM_TEXT_PIECE_PATTERN.findall(fragment):
+                # 沒有任何分隔符的長文字只能硬切成小段 (Python 以 code point 切，不會切斷 surrogate pair)
+                while telegram_text_length(piece) > max_piece:
+                    head = piece[:max(1, max_piece // 16)]
+                    tokens.append((head, telegram_text_length(head), None, None, TELEGRAM_SPLIT_ANY))
+                    piece = piece[len(head):]
+                tokens.append((piece, telegram_text_length(piece), None, None, _telegram_split_level(piece)))
+    return tokens
+
+def _apply_telegram_tag(stack, token):
+    _, _, open_tag, tag_name, _ = token
+    if open_tag:
+        stack.append((tag_name, open_tag))
+    elif tag_name:
+        for position in range(len(stack) - 1, -1, -1):
+            if stack[position][0] == tag_name:
+                del stack[position]
+                break
+
+def split_telegram_html(html_text, limit=TELEGRAM_MESSAGE_LIMIT):
+    """
+    將 Telegram HTML 分成多則訊息，每則解析後的文字長度不超過 limit
+    優先在章節、段落、換行、句子、空白處分段；跨段的標籤在前一則結尾關閉、下一則開頭重新開啟
+    """
+    if not html_text:
+        return []
+    if telegram_text_length(html_text) <= limit:
+        return [html_text]
+
+    tokens = _tokenize_telegram_html(html_text, max(1, limit // 4))
+    parts = []
+    start = 0
+    start_stack = []
+    while start < len(tokens):
+        stack = list(start_stack)
+        length = 0
+        candidates = []  # (結束位置, 分段等級, 已累積長度, 當時的標籤堆疊)
+        end = start
+        while end < len(tokens) and length + tokens[end][1] <= limit:
+            length += tokens[end][1]
+            _apply_telegram_tag(stack, tokens[end])
+            level = tokens[end][4]
+            end += 1
+            if end == len(tokens):
+                candidates.append((end, TELEGRAM_SPLIT_SECTION, length, list(stack)))
+                continue
+            following = tokens[end]
+            if following[2] is None and following[3]:
+                continue  # 不在關閉標籤前分段，避免下一則開頭出現空標籤
+            if level == TELEGRAM_SPLIT_PARAGRAPH and (following[2] or following[0].startswith('----------')):
+                level = TELEGRAM_SPLIT_SECTION
+            candidates.append((end, level, length, list(stack)))
+
+        if end < len(tokens):
+            # 優先選等級最高、且不會讓這則訊息太短的位置
+            usable = [c for c in candidates if c[2] >= limit // 4] or candidates
+            if usable:
+                best_level = min(c[1] for c in usable)
+                end, _, _, stack = [c for c in usable if c[1] == best_level][-1]
+            else:
+                # 沒有可分段處時至少前進一個片段
+                end = max(end, start + 1)
+                stack = list(start_stack)
+                for token in tokens[start:end]:
+                    _apply_telegram_tag(stack, token)
+
+        body = ''.join(token[0] for token in tokens[start:end])
+        reopen = ''.join(open_tag for _, open_tag in start_stack)
+        close = ''.join(f'</{tag_name}>' for tag_name, _ in reversed(stack))
+        part = (reopen + body + close).strip()
+        if re.sub(r'<[^>]+>', '', part).strip():
+            parts.append(part)
+        start = end
+        start_stack = stack
+    return parts
+
+async def send_html_message(bot, chat_id, html_text, **kwargs):
+    """
+    將已格式化的 Telegram HTML 分段後依序發送 (間隔與 RetryAfter 重送由 TelegramRateLimiter 處理)；
+    若某段仍被 Telegram 判定為無效 HTML，改以純文字發送該段，避免整份摘要遺失
+    """
+    messages = []
+    for part in split_telegram_html(html_text):
+        try:
+            messages.append(await bot.send_message(chat_id=chat_id, text=part, parse_mode='HTML', **kwargs))
+        except BadRequest as e:
+            if "parse" not in str(e).lower():
+                raise
+            print(f"HTML part rejected, sending as plain text: {e}")
+            plain_text = html_lib.unescape(re.sub(r'<[^>]+>', '', part))
+            messages.append(await bot.send_message(chat_id=chat_id, text=plain_text, **kwargs))
+    return messages
+
+# Telegram 發送限速 (所有 bot 請求都經過 TelegramRateLimiter)
+telegram_global_rate = float(os.environ.get("TELEGRAM_GLOBAL_RATE", 25))  # 整個 bot 每秒最多送出的訊息數 (Telegram 約 30/s)，0 表示不限
+telegram_chat_interval = float(os.environ.get("TELEGRAM_CHAT_INTERVAL", 1.0))  # 同一私訊聊天室兩則訊息的最短間隔秒數
+telegram_group_rpm = int(os.environ.get("TELEGRAM_GROUP_RPM", 20))  # 同一群組每分鐘最多送出的訊息數
+telegram_send_retries = int(os.environ.get("TELEGRAM_SEND_RETRIES", 3))  # 遇到 RetryAfter 時的重送次數
+
+# 會被限速的請求：發送、編輯、轉傳訊息 (刪除訊息、回應按鈕等不計入 Telegram 的訊息額度)
+TELEGRAM_LIMITED_ENDPOINT_PREFIXES = ("send", "edit", "copy", "forward")
+TELEGRAM_CHAT_BUCKETS_MAX = 1024  # 超過時清除額度已回滿的閒置聊天室
+TELEGRAM_EDIT_CONTENTS_MAX = 1024  # 記住最後編輯參數的訊息數
+
+class TokenBucket:
+    """asyncio 用的 token bucket；reserve() 預約一個 token 並返回需要等待的秒數，依呼叫順序排隊"""
+
+    def __init__(self, rate, capacity):
+        self.rate = rate
+        self.capacity = capacity
+        self._tokens = capacity
+        self._updated = time.monotonic()
+
+    def _refill(self):
+        now = time.monotonic()
+        self._tokens = min(self.capacity, self._tokens + (now - self._updated) * self.rate)
+        self._updated = now
+
+    def reserve(self):
+        self._refill()
+        self._tokens -= 1
+        return 0.0 if self._tokens >= 0 else -self._tokens / self.rate
+
+    def idle(self):
+        self._refill()
+        return self._tokens >= self.capacity
+
+class TelegramRateLimiter(BaseRateLimiter):
+    """
+    所有送往 Telegram 的請求都經過這裡 (ApplicationBuilder.rate_limiter)。
+    發送 / 編輯類請求先依聊天室限速 (私訊每 TELEGRAM_CHAT_INTERVAL 秒一則，群組每分鐘 TELEGRAM_GROUP_RPM 則)，
+    再取得全域 token bucket 的額度；收到 RetryAfter 時整個 bot 暫停到允許的時間後重送。
+    排隊期間同一則訊息有更新的編輯時，舊的編輯直接略過；與上次送出的參數 (文字、按鈕、parse_mode 等) 完全相同的編輯也不再送出。
+    rate_limit_args 可傳入 {"max_retries": n} 覆寫單一請求的重送次數。
+    """
+
+    def __init__(self, global_rate, chat_interval, group_rpm, max_retries):
+        self._global_bucket = TokenBucket(global_rate, max(1.0, global_rate)) if global_rate > 0 else None
+        self._chat_interval = chat_interval
+        self._group_rpm = group_rpm
+        self._max_retries = max_retries
+        self._chat_buckets = {}
+        self._resume_at = 0.0  # RetryAfter 之後恢復發送的時間
+        self._edit_generations = {}  # (chat_id, message_id) -> 最新一次編輯的序號
+        self._edit_contents = OrderedDict()  # (chat_id, message_id) -> 最後送出的編輯參數 (文字、按鈕、parse_mode 等)
+        self.stats = {
+            "requests": 0,
+            "throttled": 0,
+            "delay_seconds": 0.0,
+            "max_delay_seconds": 0.0,
+            "retry_after": 0,
+            "coalesced_edits": 0,
+            "unchanged_edits": 0,
+        }
 
+    async def initialize(self):
+        pass
+
+    async def shutdown(self):
+        pass
+
+    def _chat_bucket(self, chat_id):
+        bucket = self._chat_buckets.get(chat_id)
+        if bucket is not None:
+            return bucket
+        if len(self._chat_buckets) >= TELEGRAM_CHAT_BUCKETS_MAX:
+            self._chat_buckets = {key: value for key, value in self._chat_buckets.items() if not value.idle()}
+        try:
+            is_group = int(chat_id) < 0
+        except (TypeError, ValueError):
+            is_group = True  # @channel_username
+        bucket = None  # 對應的限制設為 0 時不限速
+        if is_group and self._group_rpm > 0:
+            bucket = TokenBucket(self._group_rpm / 60, self._group_rpm)
+        elif not is_group and self._chat_interval > 0:
+            bucket = TokenBucket(1 / self._chat_interval, 1)
+        self._chat_buckets[chat_id] = bucket
+        return bucket
+
+    async def _throttle(self, chat_id):
+        """等待聊天室與全域額度，返回等待的秒數"""
+        started = time.monotonic()
+        chat_bucket = self._chat_bucket(chat_id)
+        if chat_bucket is not None:
+            delay = chat_bucket.reserve()
+            if delay > 0:
+                await asyncio.sleep(delay)
+        delay = self._global_bucket.reserve() if self._global_bucket is not None else 0.0
+        delay = max(delay, self._resume_at - time.monotonic())
+        if delay > 0:
+            await asyncio.sleep(delay)
+        waited = time.monotonic() - started
+        if waited > 0.001:
+            self.stats["throttled"] += 1
+            self.stats["delay_seconds"] += waited
+            self.stats["max_delay_seconds"] = max(self.stats["max_delay_seconds"], waited)
+        return waited
+
+    async def process_request(self, callback, args, kwargs, endpoint, data, rate_limit_args):
+        self.stats["requests"] += 1
+        max_retries = self._max_retries
+        if isinstance(rate_limit_args, dict):
+            max_retries = rate_limit_args.get("max_retries", max_retries)
+        chat_id = data.get("chat_id")
+        limited = chat_id is not None and endpoint.startswith(TELEGRAM_LIMITED_ENDPOINT_PREFIXES)
+
+        edit_key = None
+        if endpoint == "editMessageText" and chat_id is not None and data.get("message_id") is not None:
+            edit_key = (chat_id, data["message_id"])
+            edit_content = json.dumps(data, sort_keys=True, default=str)
+            if self._edit_contents.get(edit_key) == edit_content:
+                # 文字、按鈕與格式都沒變，Telegram 只會回 "message is not modified"
+                self.stats["unchanged_edits"] += 1
+                return True
+            generation = self._edit_generations.get(edit_key, 0) + 1
+            self._edit_generations[edit_key] = generation
+
+        try:
+            for attempt in range(max_retries + 1):
+                if limited:
+                    await self._throttle(chat_id)
+                elif self._resume_at > time.monotonic():
+                    await asyncio.sleep(self._resume_at - time.monotonic())
+                if edit_key and self._edit_generations.get(edit_key) != generation:
+                    # 排隊期間已有更新的編輯，這次的內容不必再送
+                    self.stats["coalesced_edits"] += 1
+                    return True
+                try:
+                    result = await callback(*args, **kwargs)
+                except RetryAfter as e:
+                    self.stats["retry_after"] += 1
+                    self._resume_at = max(self._resume_at, time.monotonic() + e.retry_after)
+                    if attempt == max_retries:
+                        raise
+                    print(f"Telegram flood control on {endpoint}, retrying in {e.retry_after}s")
+                    continue
+                if edit_key:
+                    self._edit_contents[edit_key] = edit_content
+                    self._edit_contents.move_to_end(edit_key)
+                    if len(self._edit_contents) > TELEGRAM_EDIT_CONTENTS_MAX:
+                        self._edit_contents.popitem(last=False)
+                return result
+        finally:
+            if edit_key and self._edit_generations.get(edit_key) == generation:
+                del self._edit_generations[edit_key]
+
+telegram_rate_limiter = TelegramRateLimiter(telegram_global_rate, telegram_chat_interval, telegram_group_rpm, telegram_send_retries)
+
+
+
+
+# yt-dlp info dict 快取設定
+ytdlp_info_cache_ttl = int(os.environ.get("YTDLP_INFO_CACHE_TTL", 300))  # 秒，影片串流網址約數小時後失效，不宜過長
+ytdlp_info_error_ttl = 30  # 擷取失敗的結果只短暫保留，讓同一請求內不重複失敗，之後仍可重試
+
+# 只擷取資訊時共用的 yt-dlp 設定
+YTDLP_INFO_OPTS = {
+    'quiet': True,
+    'no_warnings': True,
+    'cookiesfrombrowser': ('chrome', '/chrome-data/.config/google-chrome', None, None),
+    'extractor_args': {'youtube': {'player_client': ['default,-web_safari']}},
+    'force_ipv4': True,
+    'geo_bypass': True,
+}
+
+class YtdlpInfoCache:
+    """
+    yt-dlp info dict 快取：支援檢測、字幕擷取、音頻下載與標題查詢共用同一次 extract_info，
+    一個影片摘要只解析一次頁面、player JS 與 cookies；短時間內的重複請求也能命中
+    """
+
+    def __init__(self, ttl, max_items=256):
+        self._ttl = ttl
+        self._max_items = max_items
+        self._entries = OrderedDict()  # key -> (過期時間, info 或 exception)
+        self._lock = threading.Lock()
+        self._key_locks = {}
+        self.hits = 0
+        self.misses = 0
+
+    def _lookup(self, key):
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry and entry[0] > time.monotonic():
+                self._entries.move_to_end(key)
+                return entry
+            self._entries.pop(key, None)
+            return None
+
+    def get(self, url):
+        """返回 url 的 info dict，擷取失敗時拋出與 extract_info 相同的例外 (阻塞，需在執行緒池中呼叫)"""
+        key = canonicalize_url(url)
+        with self._lock:
+            key_lock = self._key_locks.setdefault(key, threading.Lock())
+        # 同一個 URL 同時只擷取一次，其餘等待結果
+        with key_lock:
+            entry = self._lookup(key)
+            if entry:
+                self.hits += 1
+            else:
+                self.misses += 1
+                try:
+                    with yt_dlp.YoutubeDL(YTDLP_INFO_OPTS) as ydl:
+                        entry = (time.monotonic() + self._ttl, ydl.extract_info(url, download=False))
+                except Exception as e:
+                    entry = (time.monotonic() + ytdlp_info_error_ttl, e)
+                with self._lock:
+                    self._entries[key] = entry
+                    while len(self._entries) > self._max_items:
+                        self._entries.popitem(last=False)
+        with self._lock:
+            self._key_locks.pop(key, None)
+        if isinstance(entry[1], Exception):
+            raise entry[1]
+        return entry[1]
+
+    def peek(self, url):
+        """返回已快取且未過期的 info dict，沒有時返回 None (不會觸發擷取)"""
+        entry = self._lookup(canonicalize_url(url))
+        if entry is None or isinstance(entry[1], Exception):
+            return None
+        return entry[1]
+
+    def hit_rate(self):
+        total = self.hits + self.misses
+        return self.hits / total if total else 0.0
+
+ytdlp_info_cache = YtdlpInfoCache(ytdlp_info_cache_ttl)
+
+def get_ytdlp_info(url):
+    """取得 url 的 yt-dlp info dict (經由快取)"""
+    return ytdlp_info_cache.get(url)
+
+def process_ytdlp_info(ydl, info, download=True):
+    """
+    以指定的 YoutubeDL 設定處理已擷取的 info dict (下載字幕、音頻等)，不再重新解析頁面
+    與 yt-dlp --load-info-json 相同，先移除上次處理留下的私有欄位
+    """
+    return ydl.process_ie_result(ydl.sanitize_info(info, remove_private_keys=True), download=download)
+
+# 已知的影片網站 URL 模式 (不符合的網址一律當成一般網頁，不呼叫 yt-dlp)
+VIDEO_SITE_PATTERNS = [
+    r'youtube\.com|youtu\.be',
+    r'vimeo\.com',
+    r'bilibili\.com',
+    r'dailymotion\.com',
+    r'tiktok\.com',
+    r'twitch\.tv',
+    r'facebook\.com/watch|fb\.watch',
+    r'instagram\.com/(p|reel|tv)',
+    r'twitter\.com/.*/status|x\.com/.*/status',
+    r'soundcloud\.com',
+    r'spotify\.com',
+    r'bandcamp\.com',
+    r'ted\.com/talks',
+    r'coursera\.org',
+    r'khanacademy\.org',
+    r'archive\.org',
+    r'pocketcasts\.com/podcast',
+    r'player\.soundon\.fm',
+    r'podcasts\.apple\.com'
+]
+
+def matches_video_site(url):
+    url_lower = url.lower()
+    return any(re.search(pattern, url_lower) for pattern in VIDEO_SITE_PATTERNS)
 
 def is_supported_by_ytdlp(url):
     """
@@ -338,72 +1743,39 @@ def is_supported_by_ytdlp(url):
     使用雙重檢測：URL 模式 + yt-dlp 檢測，避免將一般網站誤判為影片網站
     """
     # 第一層：URL 模式檢測已知的影片網站
-    video_site_patterns = [
-        r'youtube\.com|youtu\.be',
-        r'vimeo\.com',
-        r'bilibili\.com',
-        r'dailymotion\.com',
-        r'tiktok\.com',
-        r'twitch\.tv',
-        r'facebook\.com/watch|fb\.watch',
-        r'instagram\.com/(p|reel|tv)',
-        r'twitter\.com/.*/status|x\.com/.*/status',
-        r'soundcloud\.com',
-        r'spotify\.com',
-        r'bandcamp\.com',
-        r'ted\.com/talks',
-        r'coursera\.org',
-        r'khanacademy\.org',
-        r'archive\.org',
-        r'pocketcasts\.com/podcast',
-        r'player\.soundon\.fm',
-        r'podcasts\.apple\.com'
-    ]
-    
     # 如果 URL 不匹配任何已知的影片網站模式，直接返回 False
-    url_lower = url.lower()
-    if not any(re.search(pattern, url_lower) for pattern in video_site_patterns):
+    if not matches_video_site(url):
         print(f"URL {url} doesn't match known video site patterns")
         return False
     
-    # 第二層：使用 yt-dlp 進行詳細檢測
+    # 第二層：使用 yt-dlp 進行詳細檢測 (info dict 會快取給後續字幕與標題使用)
     try:
-        ydl_opts = {
-            'quiet': True,
-            'no_warnings': True,
-            'cookiesfrombrowser': ('chrome', '/chrome-data/.config/google-chrome', None, None),
-            'extractor_args': {'youtube': {'player_client': ['default,-web_safari']}},
-            'force_ipv4': True,
-            'geo_bypass': True,
-        }
-        
-        with yt_dlp.YoutubeDL(ydl_opts) as ydl:
-            # 嘗試提取資訊而不下載
-            info = ydl.extract_info(url, download=False)
-            if info:
-                # 檢查是否包含影片相關的欄位
-                video_indicators = [
-                    'formats',           # 影片格式列表
-                    'duration',          # 影片長度
-                    'view_count',        # 觀看次數
-                    'like_count',        # 按讚數
-                    'upload_date',       # 上傳日期
-                    'uploader',          # 上傳者
-                ]
-                
-                # 如果有 formats 欄位且不為空，很可能是影片
-                if 'formats' in info and info['formats']:
-                    return True
-                
-                # 如果有 duration 且大於 0，很可能是影片
-                if 'duration' in info and info.get('duration', 0) > 0:
-                    return True
-                
-                # 檢查是否有其他影片相關欄位
-                if any(key in info for key in video_indicators):
-                    return True
-                
-                return False
+        # 嘗試提取資訊而不下載
+        info = get_ytdlp_info(url)
+        if info:
+            # 檢查是否包含影片相關的欄位
+            video_indicators = [
+                'formats',           # 影片格式列表
+                'duration',          # 影片長度
+                'view_count',        # 觀看次數
+                'like_count',        # 按讚數
+                'upload_date',       # 上傳日期
+                'uploader',          # 上傳者
+            ]
+            
+            # 如果有 formats 欄位且不為空，很可能是影片
+            if 'formats' in info and info['formats']:
+                return True
+            
+            # 如果有 duration 且大於 0，很可能是影片
+            if 'duration' in info and info.get('duration', 0) > 0:
+                return True
+            
+            # 檢查是否有其他影片相關欄位
+            if any(key in info for key in video_indicators):
+                return True
+            
+            return False
     except Exception as e:
         print(f"URL {url} extraction failed in validation: {e}")
         # Even if yt-dlp throws an error (e.g. YouTube bot detection), 
@@ -413,6 +1785,83 @@ def is_supported_by_ytdlp(url):
     
     return False
 
+# 轉錄結果快取設定 (字幕與 Whisper 轉錄共用)
+transcript_cache_size = int(os.environ.get("TRANSCRIPT_CACHE_SIZE", 64))  # 記憶體 LRU 保存的轉錄數量
+transcript_store_ttl = int(os.environ.get("TRANSCRIPT_STORE_TTL", 30 * 24 * 3600))  # MongoDB 保存秒數，0 表示永久保存
+
+class TranscriptStore:
+    """
+    以內容位址為 key 的轉錄結果快取，影片與 podcast 共用：
+      - ytdlp:<extractor>:<video id>  影片字幕或影片音頻轉錄
+      - podcast:<enclosure URL>       podcast 音頻轉錄
+      - audio:<sha256>                以音頻內容雜湊識別的轉錄
+    前面是記憶體 LRU，後面是 MongoDB transcripts collection。
+    轉錄結果與摘要語言無關，切換語言不會重新轉錄。
+    """
+
+    def __init__(self, collection, max_memory_items):
+        self._collection = collection
+        self._max_memory_items = max_memory_items
+        self._memory = OrderedDict()
+        self._lock = threading.Lock()
+
+    def _remember(self, key, text):
+        with self._lock:
+            self._memory[key] = text
+            self._memory.move_to_end(key)
+            while len(self._memory) > self._max_memory_items:
+                self._memory.popitem(last=False)
+
+    def get(self, key):
+        """返回快取的轉錄文字，沒有則返回 None (阻塞，需在執行緒池中呼叫)"""
+        with self._lock:
+            if key in self._memory:
+                self._memory.move_to_end(key)
+                return self._memory[key]
+        try:
+            doc = self._collection.find_one({"_id": key})
+        except Exception as e:
+            print(f"Error reading transcript store: {e}")
+            return None
+        if not doc:
+            return None
+        self._remember(key, doc["text"])
+        return doc["text"]
+
+    def put(self, keys, text, source):
+        """以一或多個 key 保存轉錄文字 (阻塞，需在執行緒池中呼叫)"""
+        if not text or not text.strip():
+            return
+        if isinstance(keys, str):
+            keys = [keys]
+        now = datetime.now()
+        for key in keys:
+            self._remember(key, text)
+            doc = {"_id": key, "text": text, "source": source, "created_at": now}
+            if transcript_store_ttl:
+                doc["expires_at"] = now + timedelta(seconds=transcript_store_ttl)
+            try:
+                self._collection.replace_one({"_id": key}, doc, upsert=True)
+            except Exception as e:
+                print(f"Error writing transcript store: {e}")
+
+transcript_store = TranscriptStore(transcript_collection, transcript_cache_size)
+
+def video_transcript_key(info):
+    """影片轉錄的 key：yt-dlp extractor + 影片 id"""
+    return f"ytdlp:{info.get('extractor_key') or info.get('extractor')}:{info['id']}"
+
+def podcast_transcript_key(audio_url):
+    return f"podcast:{audio_url}"
+
+def audio_content_key(file_path):
+    """以音頻檔內容的 sha256 作為 key，同一音頻換了 URL 也能命中"""
+    digest = hashlib.sha256()
+    with open(file_path, 'rb') as f:
+        for block in iter(lambda: f.read(1024 * 1024), b''):
+            digest.update(block)
+    return f"audio:{digest.hexdigest()}"
+
 def clean_subtitle(subtitle_content):
     # 移除 WEBVTT 標頭
     subtitle_content = re.sub(r'WEBVTT\n\n', '', subtitle_content)
@@ -445,12 +1894,20 @@ def extract_video_transcript(video_url):
     }
 
     try:
+        # 使用快取的 info dict，不再重新解析頁面
+        info = get_ytdlp_info(video_url)
+        video_id = info['id']
+
+        # 先查轉錄快取 (包含先前字幕或音頻轉錄的結果)
+        transcript_key = video_transcript_key(info)
+        cached_transcript = transcript_store.get(transcript_key)
+        if cached_transcript:
+            print(f"Transcript store hit for {transcript_key}")
+            return cached_transcript
+
         with yt_dlp.YoutubeDL(ydl_opts) as ydl:
-            info = ydl.extract_info(video_url, download=False)
-            video_id = info['id']
-            
             if 'subtitles' in info or 'automatic_captions' in info:
-                ydl.download([video_url])
+                process_ytdlp_info(ydl, info, download=True)
                 
                 subtitle_content = None
                 for lang in ['en','zh-Hant', 'zh-Hans', 'zh']:
@@ -465,6 +1922,7 @@ def extract_video_transcript(video_url):
                 if subtitle_content:
                     # 清理字幕內容
                     cleaned_content = clean_subtitle(subtitle_content)
+                    transcript_store.put(transcript_key, cleaned_content, source="subtitle")
                     return cleaned_content
                 else:
                     print("No suitable subtitles found in specified languages.")
@@ -500,36 +1958,230 @@ def retrieve_video_transcript_from_url(video_url):
         cleaned_content = re.sub(r'\n\n', ' ', cleaned_content)
 
         # 將清理後的內容分割成chunks
-        output_chunks = []
-        current_chunk = ""
-        for word in cleaned_content.split():
-            if len(current_chunk) + len(word) + 1 <= chunk_size:
-                current_chunk += word + ' '
-            else:
-                output_chunks.append(current_chunk.strip())
-                current_chunk = word + ' '
-
-        if current_chunk:
-            output_chunks.append(current_chunk.strip())
-
-        return output_chunks
+        return chunk_text(cleaned_content)
 
     except Exception as e:
         print(f"Error in retrieve_video_transcript_from_url: {e}")
         return ["無法獲取字幕或進行音頻轉換。"]
     
+# 音頻切割設定
+FFMPEG_PATH = '/usr/bin/ffmpeg'
+audio_segment_seconds = 100  # Whisper 每個片段的長度
+
+# 轉錄上傳用的音頻編碼設定。Whisper 內部以 16 kHz 單聲道處理，更高的取樣率與立體聲只會增加上傳量
+TRANSCRIPTION_AUDIO_PROFILES = {
+    # 16 kHz 單聲道 Opus 24 kbps (VBR)：約 11–17 MB / 小時
+    'opus': {'codec_args': ['-ac', '1', '-ar', '16000', '-c:a', 'libopus', '-b:a', '24k', '-application', 'voip'],
+             'ext': 'ogg', 'mime': 'audio/ogg'},
+    # 16 kHz 單聲道 FLAC (無損)：約 60 MB / 小時
+    'flac': {'codec_args': ['-ac', '1', '-ar', '16000', '-c:a', 'flac'],
+             'ext': 'flac', 'mime': 'audio/flac'},
+    # 原始取樣率的 PCM WAV：舊行為，44.1 kHz 立體聲約 635 MB / 小時
+    'wav': {'codec_args': ['-c:a', 'pcm_s16le'],
+            'ext': 'wav', 'mime': 'audio/wav'},
+}
+# 各轉錄後端使用的編碼設定 (目前僅 Groq Whisper)
+whisper_audio_profile = os.environ.get("WHISPER_AUDIO_PROFILE", "opus")
+if whisper_audio_profile not in TRANSCRIPTION_AUDIO_PROFILES:
+    print(f"Unknown WHISPER_AUDIO_PROFILE {whisper_audio_profile}, falling back to opus")
+    whisper_audio_profile = 'opus'
+
+# 下載音頻時挑選最小但足以辨識語音的格式 (至少 32 kbps)，直接交給 ffmpeg 切割，不再先轉成 192 kbps MP3
+TRANSCRIPTION_YTDLP_FORMAT = 'ba[abr>=32][protocol^=http]/ba[protocol^=http]/ba/b'
+TRANSCRIPTION_YTDLP_FORMAT_SORT = ['+abr', '+size']
+
+def segment_audio_with_ffmpeg(audio_path, segment_seconds, profile):
+    """
+    讓 ffmpeg 以串流方式解碼，依 profile 重新編碼並直接切割成固定長度的片段檔，
+    返回 (片段目錄, 依順序排列的片段路徑)
+    不會把整集音頻解碼進記憶體，記憶體用量與音頻長度無關
+    """
+    audio_profile = TRANSCRIPTION_AUDIO_PROFILES[profile]
+    segment_dir = f"/tmp/{str(uuid.uuid4())}"
+    os.makedirs(segment_dir)
+    command = [
+        FFMPEG_PATH, "-hide_banner", "-loglevel", "error", "-nostdin",
+        "-i", audio_path,
+        "-vn",
+        "-f", "segment",
+        "-segment_time", str(segment_seconds),
+        "-reset_timestamps", "1",
+        *audio_profile['codec_args'],
+        os.path.join(segment_dir, f"chunk_%05d.{audio_profile['ext']}"),
+    ]
+    try:
+        result = subprocess.run(command, capture_output=True, text=True)
+        if result.returncode != 0:
+            raise RuntimeError(f"ffmpeg segmentation failed: {result.stderr.strip()}")
+    except Exception:
+        shutil.rmtree(segment_dir, ignore_errors=True)
+        raise
+    chunk_paths = sorted(
+        os.path.join(segment_dir, name) for name in os.listdir(segment_dir) if name.startswith("chunk_")
+    )
+    return segment_dir, chunk_paths
+
+# Whisper 轉錄並行設定
+whisper_concurrency = int(os.environ.get("WHISPER_CONCURRENCY", 4))  # 同時上傳轉錄的片段數 (全域)
+whisper_rpm = max(0, int(os.environ.get("WHISPER_RPM", 20)))  # 每個 GROQ API key 每分鐘的請求上限，0 或負數表示不限速
+# GROQ_API_KEY 可用逗號分隔多個 key，片段會分散到速率額度最早可用的 key
+groq_api_keys = [key.strip() for key in groq_api_key.split(",") if key.strip()] or [groq_api_key]
+whisper_executor = ThreadPoolExecutor(max_workers=whisper_concurrency, thread_name_prefix="whisper")
+
+class KeyRateLimiter:
+    """每個 API key 的滑動視窗速率限制 (執行緒安全)，max_requests <= 0 時不限速"""
+
+    def __init__(self, max_requests, period=60.0):
+        self._max_requests = max_requests
+        self._period = period
+        self._sent = {}  # key -> deque[送出時間]
+        self._lock = threading.Lock()
+
+    def acquire(self, keys):
+        """等待直到其中一個 key 有額度，返回取得額度的 key"""
+        while True:
+            with self._lock:
+                now = time.monotonic()
+                best_key, best_wait = None, None
+                for key in keys:
+                    sent = self._sent.setdefault(key, deque())
+                    while sent and now - sent[0] >= self._period:
+                        sent.popleft()
+                    if self._max_requests <= 0:
+                        # 不限速時仍分散到近期用量最少的 key
+                        wait = 0.0
+                        if best_wait is None or len(sent) < len(self._sent[best_key]):
+                            best_key, best_wait = key, wait
+                        continue
+                    wait = 0.0 if len(sent) < self._max_requests else sent[0] + self._period - now
+                    if best_wait is None or wait < best_wait:
+                        best_key, best_wait = key, wait
+                if best_wait <= 0:
+                    self._sent[best_key].append(now)
+                    return best_key
+            time.sleep(best_wait)
+
+whisper_rate_limiter = KeyRateLimiter(whisper_rpm)
+
+# Whisper API 設定
+WHISPER_API_URL = "https://api.groq.com/openai/v1/audio/transcriptions"
+WHISPER_MODEL = "whisper-large-v3"
+whisper_max_retries = int(os.environ.get("WHISPER_MAX_RETRIES", 3))  # 429 / 5xx / 連線錯誤的重試次數
+
+class WhisperClient:
+    """
+    行程內的 Whisper 轉錄 client：共用一個 keep-alive 連線池的 requests.Session，
+    直接上傳記憶體中的音頻 bytes，不再為每個片段 fork curl 與重新 TLS 握手。
+    遇到 429 / 5xx 會依 Retry-After (或指數退避) 重試，失敗時返回結構化的錯誤
+    """
+
+    RETRY_STATUS = {429, 500, 502, 503, 504}
+
+    def __init__(self, pool_size):
+        self.session = requests.Session()
+        adapter = requests.adapters.HTTPAdapter(pool_connections=1, pool_maxsize=pool_size)
+        self.session.mount("https://", adapter)
+
+    @staticmethod
+    def _retry_after_seconds(response, attempt):
+        """解析 Retry-After (秒數或 HTTP 日期)，沒有時使用指數退避"""
+        value = response.headers.get("Retry-After") if response is not None else None
+        if value:
+            try:
+                return max(0.0, float(value))
+            except ValueError:
+                try:
+                    retry_at = parsedate_to_datetime(value)
+                    return max(0.0, (retry_at - datetime.now(retry_at.tzinfo)).total_seconds())
+                except (TypeError, ValueError):
+                    pass
+        return float(2 ** attempt)
+
+    def transcribe(self, audio_bytes, filename, mime_type):
+        """
+        轉錄一段音頻，返回 (轉錄文字, 錯誤)
+        錯誤為 None 或 {"status": HTTP 狀態碼或 None, "message": 說明, "attempts": 嘗試次數}
+        """
+        error = None
+        for attempt in range(whisper_max_retries + 1):
+            api_key = whisper_rate_limiter.acquire(groq_api_keys)
+            response = None
+            try:
+                response = self.session.post(
+                    WHISPER_API_URL,
+                    headers={"Authorization": f"Bearer {api_key}"},
+                    files={"file": (filename, audio_bytes, mime_type)},
+                    data={"model": WHISPER_MODEL},
+                    timeout=(10, 180),
+                )
+            except requests.exceptions.RequestException as e:
+                error = {"status": None, "message": str(e), "attempts": attempt + 1}
+            else:
+                if response.status_code == 200:
+                    try:
+                        return response.json()["text"], None
+                    except (KeyError, ValueError) as e:
+                        return "", {"status": 200, "message": f"Invalid response: {e}", "attempts": attempt + 1}
+                error = {"status": response.status_code, "message": response.text[:500], "attempts": attempt + 1}
+                if response.status_code not in self.RETRY_STATUS:
+                    break
+            if attempt < whisper_max_retries:
+                delay = self._retry_after_seconds(response, attempt)
+                print(f"Whisper request failed ({error['status']}), retrying in {delay:.1f}s")
+                time.sleep(delay)
+        return "", error
+
+whisper_client = WhisperClient(whisper_concurrency)
+
+def transcribe_audio_chunk(index, total, chunk_path, mime_type):
+    """讀入片段後立即刪除暫存檔並轉錄，返回 (轉錄文字, 錯誤或 None)"""
+    try:
+        with open(chunk_path, 'rb') as f:
+            audio_bytes = f.read()
+    finally:
+        os.remove(chunk_path)  # 刪除臨時音訊文件
+
+    print(f"Transcribing chunk {index+1}/{total}")
+    text, error = whisper_client.transcribe(audio_bytes, os.path.basename(chunk_path), mime_type)
+    if error:
+        error["chunk"] = index + 1
+        print(f"Error transcribing chunk {index+1}/{total}: {error}")
+    return text, error
+
+def transcribe_audio_file(audio_path):
+    """
+    將音頻檔切成 100 秒的片段，並行送到 Groq Whisper 轉錄 (WHISPER_CONCURRENCY / WHISPER_RPM 限制)，
+    再依片段順序組回完整文字
+    返回 (轉錄文字, 失敗片段的錯誤列表)，有片段失敗時呼叫端不應快取結果
+    """
+    # ffmpeg 串流切割並編碼成 16 kHz 單聲道的精簡格式，記憶體用量固定
+    segment_dir, chunk_paths = segment_audio_with_ffmpeg(audio_path, audio_segment_seconds, whisper_audio_profile)
+    mime_type = TRANSCRIPTION_AUDIO_PROFILES[whisper_audio_profile]['mime']
+    print(f"Audio split into {len(chunk_paths)} chunks for transcription")
+
+    try:
+        # executor.map 依輸入順序返回結果，轉錄文字不會錯位
+        results = list(whisper_executor.map(
+            transcribe_audio_chunk,
+            range(len(chunk_paths)),
+            [len(chunk_paths)] * len(chunk_paths),
+            chunk_paths,
+            [mime_type] * len(chunk_paths),
+        ))
+    finally:
+        shutil.rmtree(segment_dir, ignore_errors=True)
+    transcript = "".join(text for text, _ in results)
+    errors = [error for _, error in results if error]
+    return transcript, errors
+
 def audio_transcription(video_url):
     try:
-        # 使用 yt-dlp 下載音頻
+        # 使用 yt-dlp 下載最小但足以辨識語音的音頻格式，保留原始容器，由 ffmpeg 切割時再編碼
         ydl_opts = {
-            'format': 'bestaudio[protocol^=http]/best',
+            'format': TRANSCRIPTION_YTDLP_FORMAT,
+            'format_sort': TRANSCRIPTION_YTDLP_FORMAT_SORT,
             'outtmpl': f'/tmp/{str(uuid.uuid4())}.%(ext)s',
             'ffmpeg_location': '/usr/bin/ffmpeg',
-            'postprocessors': [{
-                'key': 'FFmpegExtractAudio',
-                'preferredcodec': 'mp3',
-                'preferredquality': '192',
-            }],
             'ffprobe_location': '/usr/bin/ffprobe',
             'cookiesfrombrowser': ('chrome', '/chrome-data/.config/google-chrome', None, None),  # 使用 cookies.txt 檔案
             'extractor_args': {'youtube': {'player_client': ['default,-web_safari']}},
@@ -537,61 +2189,26 @@ def audio_transcription(video_url):
             'geo_bypass': True,
         }
 
+        info = get_ytdlp_info(video_url)
         with yt_dlp.YoutubeDL(ydl_opts) as ydl:
-            info = ydl.extract_info(video_url, download=True)
-            output_path = ydl.prepare_filename(info)
-
-        output_path = output_path.replace(os.path.splitext(output_path)[1], ".mp3")
-        audio_file = AudioSegment.from_file(output_path)
-
-        chunk_size = 100 * 1000  # 100 秒
-        chunks = [audio_file[i:i+chunk_size] for i in range(0, len(audio_file), chunk_size)]
-
-        transcript = ""
-        for i, chunk in enumerate(chunks):
-            temp_file_path = f"/tmp/{str(uuid.uuid4())}.wav"
-            chunk.export(temp_file_path, format="wav")
-
-            curl_command = [
-                "curl",
-                "https://api.groq.com/openai/v1/audio/transcriptions",
-                "-H", f"Authorization: Bearer {os.environ.get('GROQ_API_KEY', 'YOUR_GROQ_API_KEY')}",
-                "-H", "Content-Type: multipart/form-data",
-                "-F", f"file=@{temp_file_path}",
-                "-F", "model=whisper-large-v3"
-            ]
-
-            result = subprocess.run(curl_command, capture_output=True, text=True)
-
-            try:
-                response_json = json.loads(result.stdout)
-                transcript += response_json["text"]
-            except KeyError as e:
-                print("KeyError:", e)
-                print("Response JSON:", response_json)
-            except json.JSONDecodeError:
-                print("Failed to decode JSON:", result.stdout)
-
-            os.remove(temp_file_path)  # 刪除臨時音訊文件
+            downloaded_info = process_ytdlp_info(ydl, info, download=True)
+            output_path = ydl.prepare_filename(downloaded_info)
+
+        # 同一段音頻可能來自不同網址，先以內容雜湊查詢轉錄快取
+        audio_key = audio_content_key(output_path)
+        transcript = transcript_store.get(audio_key)
+        if transcript is None:
+            transcript, errors = transcribe_audio_file(output_path)
+            if not errors:
+                transcript_store.put([video_transcript_key(info), audio_key], transcript, source="whisper")
+        else:
+            # 以影片 key 再存一份，下次不必下載音頻就能命中
+            transcript_store.put(video_transcript_key(info), transcript, source="whisper")
 
-        os.remove(output_path)  # 刪除下載的 mp3 文件
+        os.remove(output_path)  # 刪除下載的音頻文件
 
         # 將轉錄文本分割成 chunks
-        output_sentences = transcript.split()
-        output_chunks = []
-        current_chunk = ""
-
-        for word in output_sentences:
-            if len(current_chunk) + len(word) + 1 <= chunk_size:
-                current_chunk += word + ' '
-            else:
-                output_chunks.append(current_chunk.strip())
-                current_chunk = word + ' '
-
-        if current_chunk:
-            output_chunks.append(current_chunk.strip())
-
-        return output_chunks
+        return chunk_text(transcript)
 
     except Exception as e:
         print(f"Error in audio_transcription: {e}")
@@ -804,74 +2421,41 @@ def download_and_transcribe_podcast(audio_url):
     下載 podcast 音頻並使用 Whisper 轉錄
     """
     try:
-        print(f"Downloading podcast audio from: {audio_url}")
-        
-        # 下載音頻文件
-        temp_audio_path = f"/tmp/{str(uuid.uuid4())}.mp3"
-        response = requests.get(audio_url, stream=True, timeout=300)
-        response.raise_for_status()
-        
-        with open(temp_audio_path, 'wb') as f:
-            for chunk in response.iter_content(chunk_size=8192):
-                if chunk:
-                    f.write(chunk)
-        
-        print(f"Audio downloaded to {temp_audio_path}")
-        
-        # 載入音頻文件
-        audio_file = AudioSegment.from_file(temp_audio_path)
-        
-        # 分割成較小的塊進行轉錄(100秒一塊)
-        chunk_duration = 100 * 1000  # 毫秒
-        chunks = [audio_file[i:i+chunk_duration] for i in range(0, len(audio_file), chunk_duration)]
-        
-        print(f"Audio split into {len(chunks)} chunks for transcription")
-        
-        transcript = ""
-        for i, chunk in enumerate(chunks):
-            print(f"Transcribing chunk {i+1}/{len(chunks)}")
-            temp_chunk_path = f"/tmp/{str(uuid.uuid4())}.wav"
-            chunk.export(temp_chunk_path, format="wav")
+        # 同一集 podcast 先查轉錄快取，命中時連下載都不需要
+        podcast_key = podcast_transcript_key(audio_url)
+        transcript = transcript_store.get(podcast_key)
+        if transcript is not None:
+            print(f"Transcript store hit for {podcast_key}")
+        else:
+            print(f"Downloading podcast audio from: {audio_url}")
             
-            # 使用 Groq Whisper API 轉錄
-            curl_command = [
-                "curl",
-                "https://api.groq.com/openai/v1/audio/transcriptions",
-                "-H", f"Authorization: Bearer {groq_api_key}",
-                "-H", "Content-Type: multipart/form-data",
-                "-F", f"file=@{temp_chunk_path}",
-                "-F", "model=whisper-large-v3"
-            ]
+            # 下載音頻文件
+            temp_audio_path = f"/tmp/{str(uuid.uuid4())}.mp3"
+            response = requests.get(audio_url, stream=True, timeout=300)
+            response.raise_for_status()
             
-            result = subprocess.run(curl_command, capture_output=True, text=True)
+            with open(temp_audio_path, 'wb') as f:
+                for chunk in response.iter_content(chunk_size=8192):
+                    if chunk:
+                        f.write(chunk)
             
-            try:
-                response_json = json.loads(result.stdout)
-                transcript += response_json.get("text", "")
-            except (KeyError, json.JSONDecodeError) as e:
-                print(f"Error decoding transcription response: {e}")
+            print(f"Audio downloaded to {temp_audio_path}")
+
+            # 相同音頻換了 enclosure URL 時以內容雜湊命中
+            audio_key = audio_content_key(temp_audio_path)
+            transcript = transcript_store.get(audio_key)
+            if transcript is None:
+                transcript, errors = transcribe_audio_file(temp_audio_path)
+                if not errors:
+                    transcript_store.put([podcast_key, audio_key], transcript, source="whisper")
+            else:
+                transcript_store.put(podcast_key, transcript, source="whisper")
             
-            os.remove(temp_chunk_path)
-        
-        # 清理下載的音頻文件
-        os.remove(temp_audio_path)
+            # 清理下載的音頻文件
+            os.remove(temp_audio_path)
         
         # 將轉錄文本分割成chunks
-        output_chunks = []
-        current_chunk = ""
-        words = transcript.split()
-        
-        for word in words:
-            if len(current_chunk) + len(word) + 1 <= chunk_size:
-                current_chunk += word + ' '
-            else:
-                output_chunks.append(current_chunk.strip())
-                current_chunk = word + ' '
-        
-        if current_chunk:
-            output_chunks.append(current_chunk.strip())
-        
-        return output_chunks
+        return chunk_text(transcript)
         
     except Exception as e:
         print(f"Error downloading and transcribing podcast: {e}")
@@ -958,10 +2542,118 @@ def process_apple_podcast_url(url):
         print(f"Error processing Apple Podcast URL: {e}")
         return ["處理 Apple Podcast URL 時發生錯誤。"]
 
-def call_gpt_api(prompt, additional_messages=[], use_llm2_model=False, selected_model=None):
+# LLM 連線設定
+llm_connect_timeout = float(os.environ.get("LLM_CONNECT_TIMEOUT", 10))  # 秒
+llm_read_timeout = float(os.environ.get("LLM_READ_TIMEOUT", 300))  # 秒，長文摘要可能需要較久
+llm_max_connections = int(os.environ.get("LLM_MAX_CONNECTIONS", 20))  # 每個 base_url 的連線上限
+llm_http2 = int(os.environ.get("LLM_HTTP2", 1))  # 1 啟用 HTTP/2，0 僅使用 HTTP/1.1
+
+class LLMClientPool:
+    """
+    每個 LLM base_url 維護一個長駐的 httpx.AsyncClient (keep-alive + HTTP/2)，
+    LLM1 與 LLM2 共用，避免每次摘要與續問都重新建立 TLS 連線
+    """
+
+    def __init__(self):
+        self._clients = {}
+        self._stats = {}
+
+    def get_client(self, api_base_url):
+        client = self._clients.get(api_base_url)
+        if client is None:
+            client = httpx.AsyncClient(
+                base_url=api_base_url,
+                http2=bool(llm_http2),
+                timeout=httpx.Timeout(llm_read_timeout, connect=llm_connect_timeout),
+                limits=httpx.Limits(
+                    max_connections=llm_max_connections,
+                    max_keepalive_connections=llm_max_connections,
+                    keepalive_expiry=120,
+                ),
+            )
+            self._clients[api_base_url] = client
+            self._stats[api_base_url] = {'requests': 0, 'errors': 0, 'in_flight': 0, 'total_seconds': 0.0}
+        return client
+
+    async def post_json(self, api_base_url, path, headers, payload):
+        """送出 JSON POST 請求並返回解析後的 JSON，非 2xx 狀態碼會拋出 httpx.HTTPStatusError"""
+        client = self.get_client(api_base_url)
+        stats = self._stats[api_base_url]
+        stats['requests'] += 1
+        stats['in_flight'] += 1
+        started = time.monotonic()
+        try:
+            response = await client.post(path, headers=headers, json=payload)
+            response.raise_for_status()
+            return response.json()
+        except Exception:
+            stats['errors'] += 1
+            raise
+        finally:
+            stats['in_flight'] -= 1
+            stats['total_seconds'] += time.monotonic() - started
+
+    async def stream_sse(self, api_base_url, path, headers, payload):
+        """
+        送出串流請求，逐一 yield server-sent events 中 data 欄位解析後的 JSON
+        若後端不支援串流而直接返回 JSON，則把整個回應當作單一事件 yield
+        """
+        client = self.get_client(api_base_url)
+        stats = self._stats[api_base_url]
+        stats['requests'] += 1
+        stats['in_flight'] += 1
+        started = time.monotonic()
+        try:
+            async with client.stream("POST", path, headers=headers, json=payload) as response:
+                response.raise_for_status()
+                if not response.headers.get("content-type", "").startswith("text/event-stream"):
+                    yield json.loads(await response.aread())
+                    return
+                async for line in response.aiter_lines():
+                    if not line.startswith("data:"):
+                        continue
+                    event_data = line[5:].strip()
+                    if event_data == "[DONE]":
+                        break
+                    if event_data:
+                        yield json.loads(event_data)
+        except Exception:
+            stats['errors'] += 1
+            raise
+        finally:
+            stats['in_flight'] -= 1
+            stats['total_seconds'] += time.monotonic() - started
+
+    def stats(self):
+        """返回每個 base_url 的連線池統計"""
+        result = {}
+        for api_base_url, client in self._clients.items():
+            stats = dict(self._stats[api_base_url])
+            # httpx 沒有公開連線池狀態，從底層 httpcore 連線池讀取
+            pool = getattr(getattr(client, '_transport', None), '_pool', None)
+            connections = list(getattr(pool, 'connections', []))
+            stats['connections'] = len(connections)
+            stats['idle_connections'] = sum(1 for c in connections if c.is_idle())
+            stats['http2_connections'] = sum(1 for c in connections if 'HTTP/2' in c.info())
+            finished = stats['requests'] - stats['in_flight']
+            stats['avg_seconds'] = stats['total_seconds'] / finished if finished else 0.0
+            result[api_base_url] = stats
+        return result
+
+    async def aclose(self):
+        for client in self._clients.values():
+            await client.aclose()
+        self._clients.clear()
+
+llm_client_pool = LLMClientPool()
+
+
+async def call_gpt_api(prompt, additional_messages=[], use_llm2_model=False, selected_model=None, on_delta=None):
     """呼叫 LLM API。
     - use_llm2_model=True 且 LLM2 已配置，則使用 LLM2
     - selected_model 可指定特定模型 (用戶透過 /model 選擇)
+    - on_delta 為 async callback 時改用串流 (SSE) 模式，每收到一段新文字就呼叫 on_delta(新增文字)，
+      最後仍返回完整回應
     """
     if use_llm2_model and use_llm2:
         api_key = llm2_api_key
@@ -978,21 +2670,135 @@ def call_gpt_api(prompt, additional_messages=[], use_llm2_model=False, selected_
     }
     data = {
         "model": api_model,
-        "messages": additional_messages + [
-            {"role": "user", "content": prompt}
-        ],
+        "messages": fit_messages_to_budget(
+            additional_messages + [{"role": "user", "content": prompt}],
+            api_model,
+        ),
     }
 
     try:
-        response = requests.post(f"{api_base_url}/chat/completions", headers=headers, json=data)
-        response.raise_for_status()  # 如果返回非 200 的狀態碼會拋出異常
-        message = response.json()["choices"][0]["message"]["content"].strip()
-        return message
-    except requests.exceptions.RequestException as e:
+        if on_delta is None:
+            response_json = await llm_client_pool.post_json(api_base_url, "/chat/completions", headers, data)
+            token_usage_stats["reported_prompt_tokens"] += (response_json.get("usage") or {}).get("prompt_tokens") or 0
+            message = response_json["choices"][0]["message"]["content"].strip()
+            return message
+
+        data["stream"] = True
+        parts = []
+        async for event in llm_client_pool.stream_sse(api_base_url, "/chat/completions", headers, data):
+            choices = event.get("choices") or []
+            if not choices:
+                continue
+            # 串流事件的內容在 delta；不支援串流的後端則返回完整的 message
+            content = (choices[0].get("delta") or choices[0].get("message") or {}).get("content")
+            if content:
+                parts.append(content)
+                await on_delta(content)
+        return "".join(parts).strip()
+    except httpx.HTTPError as e:
         print(f"Request error: {e}")
         return ""
 
 
+# 串流摘要設定
+stream_summary = int(os.environ.get("STREAM_SUMMARY", 1))  # 1 啟用串流並逐步更新處理中訊息，0 禁用
+stream_edit_interval = float(os.environ.get("STREAM_EDIT_INTERVAL", 1.5))  # 兩次編輯之間的最短秒數
+
+class ProgressiveMessageEditor:
+    """
+    將串流中的 LLM 輸出逐步編輯到「處理中」訊息上
+    Telegram 對同一則訊息的編輯頻率有限制，因此依 STREAM_EDIT_INTERVAL 節流，
+    收到 RetryAfter 時暫停到允許的時間點。中途以純文字顯示，最終結果仍由呼叫端格式化後發送
+    """
+
+    def __init__(self, bot, chat_id, message_id):
+        self.bot = bot
+        self.chat_id = chat_id
+        self.message_id = message_id
+        self._parts = []
+        self._next_edit_at = 0.0
+        self._last_text = None
+
+    async def on_delta(self, delta):
+        self._parts.append(delta)
+        now = time.monotonic()
+        if now < self._next_edit_at:
+            return
+        text = "".join(self._parts).strip()
+        if not text or text == self._last_text:
+            return
+        if telegram_text_length(text) > 4000:
+            # 處理中訊息只顯示最新的部分，完整摘要稍後分段發送；長度以 Telegram 計算的 UTF-16 單位為準
+            text = "…" + telegram_text_tail(text, 3990)
+        self._next_edit_at = now + stream_edit_interval
+        try:
+            # 過時的進度不值得重送，RetryAfter 時直接等下一次更新
+            await self.bot.edit_message_text(
+                chat_id=self.chat_id, message_id=self.message_id, text=text, rate_limit_args={"max_retries": 0}
+            )
+            self._last_text = text
+        except RetryAfter as e:
+            self._next_edit_at = time.monotonic() + e.retry_after
+        except BadRequest as e:
+            # 例如 "message is not modified"，忽略即可
+            print(f"Progressive edit skipped: {e}")
+
+
+def format_runtime_stats(conversation_usage=None):
+    """組合 /stats 命令顯示的執行狀態；conversation_usage 為 conversation_store.usage() 的結果"""
+    lines = ["📊 執行狀態 Runtime Stats", ""]
+    lines.append(
+        f"🎬 yt-dlp info 快取 info cache: 命中率 hit rate {ytdlp_info_cache.hit_rate():.0%} "
+        f"({ytdlp_info_cache.hits} hits / {ytdlp_info_cache.misses} misses)"
+    )
+    lines.append(
+        f"🔁 合併重複請求 coalesced requests: 擷取 extraction {extraction_flights.coalesced}/{extraction_flights.executions + extraction_flights.coalesced}, "
+        f"摘要 summary {summary_flights.coalesced}/{summary_flights.executions + summary_flights.coalesced}"
+    )
+    lines.append("")
+    lines.append("🌐 LLM 連線池 LLM connection pools:")
+    pool_stats = llm_client_pool.stats()
+    if not pool_stats:
+        lines.append("  (尚未建立連線 no connections yet)")
+    for api_base_url, stats in pool_stats.items():
+        lines.append(
+            f"  • {api_base_url}\n"
+            f"    連線 connections: {stats['connections']} (閒置 idle {stats['idle_connections']}, HTTP/2 {stats['http2_connections']})\n"
+            f"    請求 requests: {stats['requests']}, 進行中 in flight: {stats['in_flight']}, "
+            f"錯誤 errors: {stats['errors']}, 平均 avg: {stats['avg_seconds']:.2f}s"
+        )
+    lines.append("")
+    writer_stats = summary_writer.stats_snapshot()
+    lines.append(
+        f"💾 MongoDB 背景寫入 buffered writes: 緩衝 depth {summary_writer.depth()} (最高 max {writer_stats['max_depth']}), "
+        f"已寫入 written {writer_stats['written']} / {writer_stats['batches']} batches "
+        f"(上批 last {writer_stats['last_batch_seconds']:.2f}s), 丟棄 dropped {writer_stats['dropped']}, 失敗 failed {writer_stats['failed']}"
+    )
+    lines.append("")
+    lines.append(
+        f"🔢 Token 預算 token budget: {token_usage_stats['requests']} requests, "
+        f"估計輸入 estimated input ~{token_usage_stats['estimated_input_tokens']} tokens "
+        f"(API 回報 reported {token_usage_stats['reported_prompt_tokens']}), "
+        f"截斷 trimmed {token_usage_stats['trimmed_requests']}"
+    )
+    limiter_stats = telegram_rate_limiter.stats
+    average_delay = limiter_stats["delay_seconds"] / limiter_stats["throttled"] if limiter_stats["throttled"] else 0.0
+    lines.append("")
+    lines.append(
+        f"📨 Telegram 發送 outbound: {limiter_stats['requests']} requests, "
+        f"限速等待 throttled {limiter_stats['throttled']} (平均 avg {average_delay:.2f}s, 最長 max {limiter_stats['max_delay_seconds']:.2f}s), "
+        f"RetryAfter {limiter_stats['retry_after']}, 合併編輯 coalesced edits {limiter_stats['coalesced_edits']}, "
+        f"略過未變更 unchanged edits {limiter_stats['unchanged_edits']}"
+    )
+    if conversation_usage:
+        lines.append("")
+        lines.append(
+            f"💬 對話紀錄 conversations ({conversation_backend}): {conversation_usage['records']} users, "
+            f"~{conversation_usage['bytes'] / 1024:.0f} KB, 淘汰 evicted {conversation_usage['evictions']}"
+        )
+    return "\n".join(lines)
+
+
 async def handle_start(update, context):
     return await handle('start', update, context)
 
@@ -1019,6 +2825,10 @@ async def handle_show_context(update, context):
     """顯示當前對話上下文"""
     return await handle('show_context', update, context)
 
+async def handle_stats(update, context):
+    """顯示執行狀態統計"""
+    return await handle('stats', update, context)
+
 async def handle_summarize(update, context):
      return await handle('summarize', update, context)
 
@@ -1093,8 +2903,7 @@ async def handle_yt2audio(update, context):
             'geo_bypass': True,
         }
 
-        with yt_dlp.YoutubeDL(ydl_opts) as ydl:
-            info = ydl.extract_info(url, download=True)  # 下載音頻
+        await run_blocking(download_with_ytdlp, url, ydl_opts)  # 下載音頻
 
         # 確保獲取到的 mp3 文件名正確
         output_path = f"/tmp/{temp_uuid}.mp3"
@@ -1122,7 +2931,7 @@ async def handle_yt2text(update, context):
     url = user_input[1]
 
     try:
-        output_chunks = retrieve_video_transcript_from_url(url)
+        output_chunks = await run_blocking(retrieve_video_transcript_from_url, url)
 
         if output_chunks and output_chunks[0] in ["該影片沒有可用的字幕。", "無法獲取字幕，且音頻轉換功能未啟用。", "暫時無法轉錄"]:
             await context.bot.send_message(chat_id=chat_id, text=output_chunks[0])
@@ -1143,23 +2952,19 @@ async def handle_yt2text(update, context):
         print(f"Error: {e}")
         await context.bot.send_message(chat_id=chat_id, text="下載或轉換文本失敗。請檢查輸入的影片 URL 是否正確。")
 
+def download_with_ytdlp(url, ydl_opts):
+    """使用 yt-dlp 依照指定設定下載 (共用快取的 info dict)，返回 info dict (阻塞，需在執行緒池中呼叫)"""
+    info = get_ytdlp_info(url)
+    with yt_dlp.YoutubeDL(ydl_opts) as ydl:
+        return process_ytdlp_info(ydl, info, download=True)
+
 def get_video_title(video_url):
     """
     使用 yt-dlp 提取影片標題，支援所有 yt-dlp 支援的網站
     """
     try:
-        ydl_opts = {
-            'quiet': True,
-            'no_warnings': True,
-            'cookiesfrombrowser': ('chrome', '/chrome-data/.config/google-chrome', None, None),
-            'extractor_args': {'youtube': {'player_client': ['default,-web_safari']}},
-            'force_ipv4': True,
-            'geo_bypass': True,
-        }
-        
-        with yt_dlp.YoutubeDL(ydl_opts) as ydl:
-            info = ydl.extract_info(video_url, download=False)
-            return info.get('title', '影片')
+        info = get_ytdlp_info(video_url)
+        return info.get('title', '影片')
     except Exception as e:
         print(f"Error extracting video title: {e}")
         return "影片"
@@ -1224,6 +3029,18 @@ def process_user_input(user_input):
 
     return text_array
 
+def extract_content_and_title(user_input):
+    """
+    擷取網址內容並同時取得標題 (阻塞，需在執行緒池中呼叫)
+    影片標題直接取自剛擷取、仍在快取中的 yt-dlp info，不會在摘要完成後 (info 快取可能已過期) 再擷取一次
+    """
+    text_array = process_user_input(user_input)
+    if isinstance(text_array, tuple) and not text_array[0]:
+        return text_array, None
+    if isinstance(text_array, list) and len(text_array) == 1 and text_array[0] in CONTENT_ERROR_MESSAGES:
+        return text_array, None
+    return text_array, get_web_title(user_input)
+
 def clear_old_commands(telegram_token):
     url = f"https://api.telegram.org/bot{telegram_token}/deleteMyCommands"
     
@@ -1249,6 +3066,7 @@ def set_my_commands(telegram_token):
         {"command": "boa", "description": "解答之書 Book of Answers"},
         {"command": "context", "description": "顯示對話上下文 Show context"},
         {"command": "clear", "description": "清除對話歷史 Clear history"},
+        {"command": "stats", "description": "執行狀態統計 Runtime stats"},
         {"command": "yt2audio", "description": "下載影片音頻（支援 YouTube、Vimeo、Bilibili 等）"},
         {"command": "yt2text", "description": "將影片轉成文字（支援 YouTube、Vimeo、Bilibili 等）"},
     ]
@@ -1260,10 +3078,819 @@ def set_my_commands(telegram_token):
     else:
         print(f"Failed to set commands: {response.text}")
 
+def convert_document_to_text(file_path):
+    """使用 MarkItDown 將文件轉成文字 (在行程池中執行)"""
+    md = MarkItDown()
+    result = md.convert(file_path)
+    return result.text_content
+
 def is_url(text):
     url_pattern = re.compile(r'https?://\S+|www\.\S+')
     return bool(url_pattern.match(text))
 
+FOLLOWUP_MAX_QUESTION_CHARS = 500  # 有對話紀錄時，短於此長度的非網址文字視為續問
+
+def is_followup_candidate(text):
+    """有對話紀錄時會被當成續問的訊息 (非網址的短文字)"""
+    return bool(text) and not is_url(text) and len(text) < FOLLOWUP_MAX_QUESTION_CHARS
+
+# 續問用的對話紀錄設定 (取代 context.user_data['conversation_history'])
+conversation_backend = os.environ.get("CONVERSATION_BACKEND", "memory")  # memory: 單一行程；mongo: 多個 replica 共用
+conversation_max_users = int(os.environ.get("CONVERSATION_MAX_USERS", 1000))  # 最多保存幾位用戶的對話，超過時淘汰最久未使用者
+conversation_ttl = int(os.environ.get("CONVERSATION_TTL", 24 * 3600))  # 對話閒置多久後過期 (秒)
+conversation_max_messages = int(os.environ.get("CONVERSATION_MAX_MESSAGES", 6))  # 每位用戶保存的問答訊息數
+# 每份原始內容建立檢索段落的字元數上限 (約十小時的英文逐字稿)，超過時記錄在 log，結尾的內容無法被續問檢索到
+conversation_max_content_chars = int(os.environ.get("CONVERSATION_MAX_CONTENT_CHARS", 1000000))
+# memory 後端所有對話紀錄的總大小上限 (MB)，超過時淘汰最久未使用者；長逐字稿完整保存，改以總量限制記憶體
+conversation_max_memory_mb = float(os.environ.get("CONVERSATION_MAX_MEMORY_MB", 256))
+
+def conversation_record_size(record):
+    """對話紀錄的大約記憶體用量 (bytes)，以 UTF-8 長度估計"""
+    size = 0
+    for value in record.values():
+        if isinstance(value, str):
+            size += len(value.encode('utf-8'))
+        elif isinstance(value, list):
+            for item in value:
+                if isinstance(item, dict):
+                    size += sum(len(str(v).encode('utf-8')) for v in item.values())
+                else:
+                    size += len(str(item).encode('utf-8'))
+    return size
+
+class MemoryConversationBackend:
+    """行程內的 LRU + TTL 對話紀錄 (不會跨 replica 共用，重啟後消失)，以用戶數與總大小限制記憶體用量"""
+
+    blocking = False
+
+    def __init__(self, max_users, ttl, max_bytes):
+        self.max_users = max_users
+        self.ttl = ttl
+        self.max_bytes = max_bytes
+        self._records = OrderedDict()  # user_id -> (expires_at, record, 大小)
+        self._total_bytes = 0
+        self._lock = threading.Lock()
+        self.evictions = 0
+
+    def _remove(self, user_id):
+        entry = self._records.pop(user_id, None)
+        if entry is not None:
+            self._total_bytes -= entry[2]
+
+    def get(self, user_id):
+        with self._lock:
+            entry = self._records.get(user_id)
+            if entry is None:
+                return None
+            expires_at, record, size = entry
+            if expires_at < time.monotonic():
+                self._remove(user_id)
+                self.evictions += 1
+                return None
+            # 讀取也算使用，延長閒置期限 (與 MongoConversationBackend.get 一致)
+            self._records[user_id] = (time.monotonic() + self.ttl, record, size)
+            self._records.move_to_end(user_id)
+            return record
+
+    def set(self, user_id, record):
+        size = conversation_record_size(record)
+        with self._lock:
+            self._remove(user_id)
+            self._records[user_id] = (time.monotonic() + self.ttl, record, size)
+            self._total_bytes += size
+            # 剛寫入的紀錄一定保留，即使它本身就超過總大小上限
+            while len(self._records) > 1 and (len(self._records) > self.max_users or self._total_bytes > self.max_bytes):
+                self._remove(next(iter(self._records)))
+                self.evictions += 1
+
+    def delete(self, user_id):
+        with self._lock:
+            self._remove(user_id)
+
+    def usage(self):
+        with self._lock:
+            return {"records": len(self._records), "bytes": self._total_bytes, "evictions": self.evictions}
+
+class MongoConversationBackend:
+    """MongoDB 上的對話紀錄，多個 replica 共用 (阻塞呼叫)；過期由 TTL 索引處理，超過上限時淘汰最久未使用者"""
+
+    blocking = True
+
+    def __init__(self, collection, max_users, ttl):
+        self.collection = collection
+        self.max_users = max_users
+        self.ttl = ttl
+        self._indexes_ready = False
+        self.evictions = 0
+
+    def _ensure_indexes(self):
+        if self._indexes_ready:
+            return
+        ensure_ttl_index(self.collection, "expires_at", 0)
+        self.collection.create_index("updated_at")
+        self._indexes_ready = True
+
+    def get(self, user_id):
+        now = datetime.now()
+        document = self.collection.find_one_and_update(
+            {"_id": user_id, "expires_at": {"$gt": now}},
+            {"$set": {"updated_at": now, "expires_at": now + timedelta(seconds=self.ttl)}},
+        )
+        if document is None:
+            return None
+        return document["record"]
+
+    def set(self, user_id, record):
+        self._ensure_indexes()
+        now = datetime.now()
+        self.collection.replace_one(
+            {"_id": user_id},
+            {"_id": user_id, "record": record, "updated_at": now, "expires_at": now + timedelta(seconds=self.ttl)},
+            upsert=True,
+        )
+        overflow = self.collection.estimated_document_count() - self.max_users
+        if overflow > 0:
+            stale_ids = [
+                document["_id"] for document in
+                self.collection.find({}, {"_id": 1}).sort("updated_at", 1).limit(overflow)
+            ]
+            self.collection.delete_many({"_id": {"$in": stale_ids}})
+            self.evictions += len(stale_ids)
+
+    def delete(self, user_id):
+        self.collection.delete_one({"_id": user_id})
+
+    def usage(self):
+        stats = get_mongo_db().command("collStats", self.collection.name)
+        return {"records": stats.get("count", 0), "bytes": stats.get("size", 0), "evictions": self.evictions}
+
+class ConversationStore:
+    """
+    續問用的對話紀錄：摘要完成時建立，只保存續問需要的欄位，
+    並限制每位用戶的問答訊息數與原始內容長度
+    """
+
+    def __init__(self, backend, max_messages, max_content_chars):
+        self.backend = backend
+        self.max_messages = max_messages
+        self.max_content_chars = max_content_chars
+
+    async def _call(self, method, *args):
+        if self.backend.blocking:
+            return await run_blocking(method, *args)
+        return method(*args)
+
+    async def get(self, user_id):
+        try:
+            return await self._call(self.backend.get, user_id)
+        except Exception as e:
+            print(f"Error reading conversation for {user_id}: {e}")
+            return None
+
+    async def start(self, user_id, content_hash, original_content, summary, source_url, language):
+        # 原始內容以檢索段落保存，並先建立 BM25 索引，續問時不必再建立
+        content_chars = sum(len(text) for text in original_content)
+        if content_chars > self.max_content_chars:
+            print(f"Conversation content for {user_id} truncated to {self.max_content_chars} of {content_chars} chars "
+                  f"(CONVERSATION_MAX_CONTENT_CHARS); follow-ups cannot retrieve the rest")
+        passages = await run_blocking(build_passages, original_content, self.max_content_chars)
+        await run_blocking(get_passage_index, content_hash, passages)
+        record = {
+            'content_hash': content_hash,
+            'passages': passages,
+            'summary': summary,
+            'source_url': source_url,
+            'timestamp': datetime.now().strftime('%Y-%m-%d %H:%M:%S'),
+            'messages': [],
+            'language': language,
+        }
+        try:
+            await self._call(self.backend.set, user_id, record)
+        except Exception as e:
+            print(f"Error saving conversation for {user_id}: {e}")
+
+    async def add_exchange(self, user_id, record, question, answer):
+        record['messages'] = (record.get('messages', []) + [
+            {"role": "user", "content": question},
+            {"role": "assistant", "content": answer},
+        ])[-self.max_messages:]
+        try:
+            await self._call(self.backend.set, user_id, record)
+        except Exception as e:
+            print(f"Error saving conversation for {user_id}: {e}")
+
+    async def clear(self, user_id):
+        try:
+            await self._call(self.backend.delete, user_id)
+        except Exception as e:
+            print(f"Error clearing conversation for {user_id}: {e}")
+
+    async def usage(self):
+        try:
+            return await self._call(self.backend.usage)
+        except Exception as e:
+            print(f"Error reading conversation store usage: {e}")
+            return None
+
+if conversation_backend == "mongo":
+    conversation_store = ConversationStore(
+        MongoConversationBackend(LazyCollection("conversations"), conversation_max_users, conversation_ttl),
+        conversation_max_messages, conversation_max_content_chars,
+    )
+else:
+    conversation_store = ConversationStore(
+        MemoryConversationBackend(conversation_max_users, conversation_ttl, int(conversation_max_memory_mb * 1024 * 1024)),
+        conversation_max_messages, conversation_max_content_chars,
+    )
+
+# 摘要工作佇列設定：handle() 只負責建立工作，實際處理由背景 worker 從 MongoDB 領取，
+# 容器重啟後從最後的檢查點繼續，不會遺失處理中的 podcast 轉錄
+enable_job_queue = int(os.environ.get("ENABLE_JOB_QUEUE", 1))  # 0 時在 handler 內直接處理 (舊行為)
+job_lease_seconds = int(os.environ.get("JOB_LEASE_SECONDS", 120))  # 租約秒數，worker 停止續約後其他 worker 可接手
+job_max_attempts = int(os.environ.get("JOB_MAX_ATTEMPTS", 3))  # 同一工作最多被領取的次數 (避免反覆讓 worker 崩潰的工作)
+job_poll_interval = float(os.environ.get("JOB_POLL_INTERVAL", 2))  # 佇列為空時的輪詢間隔 (秒)
+
+# 工作的處理階段 (檢查點)：影片 / Podcast 擷取完成記為 transcribed，其他來源記為 fetched
+JOB_STAGES = ("fetched", "transcribed", "summarized", "delivered")
+
+# 依成本分類的工作通道，各自有獨立的 worker 數，短文與網頁不會排在 Whisper 轉錄後面
+# text: 貼上的文字、web: 一般網頁、video: 有字幕 (或已有轉錄) 的影片、audio: 需音頻轉錄的影片、podcast: Podcast
+JOB_LANE_LIMITS = {"text": 4, "web": 4, "video": 4, "audio": 2, "podcast": 2}
+JOB_LANE_LIMITS.update(json.loads(os.environ.get("JOB_LANE_LIMITS", "") or "{}"))  # JSON 覆寫，例如 {"audio": 1}
+DEFAULT_JOB_LANE = "web"
+JOB_LANE_NAMES = {"text": "文字", "web": "網頁", "video": "影片", "audio": "音頻轉錄", "podcast": "Podcast "}
+TRANSCRIBED_JOB_LANES = ("video", "audio", "podcast")
+
+class SummaryJobQueue:
+    """
+    MongoDB 上的摘要工作佇列 (所有方法皆為阻塞呼叫，需在執行緒池中執行)
+    worker 以 find_one_and_update 原子地領取工作並取得租約，處理期間定期續約；
+    worker 當機或容器重啟後租約過期，工作會被重新領取並從 stage 記錄的檢查點繼續
+    """
+
+    def __init__(self, collection, worker_collection, lease_seconds, max_attempts):
+        self.collection = collection
+        self.worker_collection = worker_collection
+        self.lease_seconds = lease_seconds
+        self.max_attempts = max_attempts
+        self.worker_id = f"{os.uname().nodename}-{os.getpid()}-{uuid.uuid4().hex[:8]}"
+        self._indexes_ready = False
+
+    def _ensure_indexes(self):
+        if self._indexes_ready:
+            return
+        self.collection.create_index([("status", 1), ("lane", 1), ("seq", 1)])
+        self.collection.create_index("lease_expires_at")
+        if job_record_ttl:
+            # 只有已結束的工作有 finished_at，排隊與處理中的工作不會過期
+            ensure_ttl_index(self.collection, "finished_at", job_record_ttl)
+        # 停止續約的 replica (當機、重啟) 由 TTL monitor 刪除，容量查詢本身也會略過已過期的紀錄
+        ensure_ttl_index(self.worker_collection, "expires_at", 0)
+        self._indexes_ready = True
+
+    def enqueue(self, job):
+        self._ensure_indexes()
+        now = datetime.now()
+        job.update({
+            "status": "queued",
+            "stage": None,
+            "attempts": 0,
+            "lease_owner": None,
+            "lease_expires_at": None,
+            "created_at": now,
+            "updated_at": now,
+            "seq": time.time_ns(),  # MongoDB 日期只到毫秒，排序與排隊位置用奈秒序號
+        })
+        self.collection.insert_one(job)
+        return job
+
+    def claim(self, lane):
+        """領取通道中最早的待處理工作，或租約已過期的處理中工作，沒有時返回 None"""
+        self._ensure_indexes()
+        now = datetime.now()
+        return self.collection.find_one_and_update(
+            {
+                "$or": [
+                    {"status": "queued"},
+                    {"status": "running", "lease_expires_at": {"$lt": now}},
+                ],
+                "attempts": {"$lt": self.max_attempts},
+                # 加入通道前建立的工作沒有 lane 欄位，交給預設通道處理
+                "lane": {"$in": [lane, None]} if lane == DEFAULT_JOB_LANE else lane,
+            },
+            {
+                "$set": {
+                    "status": "running",
+                    "lease_owner": self.worker_id,
+                    "lease_expires_at": now + timedelta(seconds=self.lease_seconds),
+                    "updated_at": now,
+                },
+                "$inc": {"attempts": 1},
+            },
+            sort=[("seq", 1)],
+            return_document=ReturnDocument.AFTER,
+        )
+
+    def register_workers(self, lane_limits):
+        """登記 (或續約) 此 replica 各通道的 worker 數，租約與工作租約相同"""
+        self._ensure_indexes()
+        now = datetime.now()
+        self.worker_collection.replace_one(
+            {"_id": self.worker_id},
+            {"_id": self.worker_id, "lanes": lane_limits, "expires_at": now + timedelta(seconds=self.lease_seconds)},
+            upsert=True,
+        )
+
+    def unregister_workers(self):
+        self.worker_collection.delete_one({"_id": self.worker_id})
+
+    def lane_capacity(self, lane):
+        """所有 replica 在此通道的 worker 總數"""
+        now = datetime.now()
+        return sum(
+            document.get("lanes", {}).get(lane, 0)
+            for document in self.worker_collection.find({"expires_at": {"$gt": now}}, {"lanes": 1})
+        )
+
+    def queue_position(self, job):
+        """返回 (通道中排在此工作前面的待處理數, 通道中處理中的工作數, 所有 replica 在通道中的 worker 數)"""
+        now = datetime.now()
+        ahead = self.collection.count_documents({
+            "status": "queued",
+            "lane": job["lane"],
+            "seq": {"$lt": job["seq"]},
+        })
+        running = self.collection.count_documents({
+            "_id": {"$ne": job["_id"]},
+            "status": "running",
+            "lane": job["lane"],
+            "lease_expires_at": {"$gte": now},
+        })
+        return ahead, running, self.lane_capacity(job["lane"])
+
+    def mark_queue_position(self, job_id, position):
+        """記錄已回報給用戶的排隊位置；工作已被領取時返回 False"""
+        result = self.collection.update_one(
+            {"_id": job_id, "status": "queued"},
+            {"$set": {"queue_position": position}},
+        )
+        return result.modified_count > 0
+
+    def renew(self, job_id):
+        self.collection.update_one(
+            {"_id": job_id, "lease_owner": self.worker_id},
+            {"$set": {"lease_expires_at": datetime.now() + timedelta(seconds=self.lease_seconds)}},
+        )
+
+    def checkpoint(self, job_id, stage, fields):
+        self.collection.update_one(
+            {"_id": job_id},
+            {"$set": dict(fields, stage=stage, updated_at=datetime.now())},
+        )
+
+    def finish(self, job_id, status, error=None):
+        self.collection.update_one(
+            {"_id": job_id},
+            {"$set": {
+                "status": status,
+                "error": error,
+                "lease_owner": None,
+                "lease_expires_at": None,
+                "updated_at": datetime.now(),
+                "finished_at": datetime.now(),
+            }},
+        )
+
+    def is_settled(self, job_id):
+        """工作已送達、已結束或已不存在時返回 True"""
+        job = self.collection.find_one({"_id": job_id}, {"status": 1, "stage": 1})
+        return job is None or job.get("status") in ("done", "failed") or job.get("stage") == "delivered"
+
+    def reap_exhausted(self):
+        """將重試次數用盡且租約過期的工作標記為失敗，返回這些工作以通知用戶"""
+        now = datetime.now()
+        exhausted = list(self.collection.find({
+            "status": "running",
+            "lease_expires_at": {"$lt": now},
+            "attempts": {"$gte": self.max_attempts},
+        }))
+        for job in exhausted:
+            self.finish(job["_id"], "failed", error="max attempts exceeded")
+        return exhausted
+
+summary_job_queue = SummaryJobQueue(job_collection, job_worker_collection, job_lease_seconds, job_max_attempts)
+
+class SummaryJobWorkers:
+    """
+    在 event loop 上執行的 worker 池，從 SummaryJobQueue 領取工作並執行 run_summary_job
+    每個通道有自己的 worker (數量即該通道的並行上限)，只領取該通道的工作；
+    各通道的 worker 數登記在 summary_workers，回報排隊位置時以所有 replica 的總容量判斷
+    """
+
+    def __init__(self, queue, lane_limits):
+        self.queue = queue
+        self.lane_limits = lane_limits
+        self._tasks = []
+        self._wakeups = {}
+
+    def start(self, application):
+        self._wakeups = {lane: asyncio.Event() for lane in self.lane_limits}
+        self._tasks = [
+            asyncio.create_task(self._run(application, lane))
+            for lane, limit in self.lane_limits.items()
+            for _ in range(limit)
+        ]
+        lanes = ", ".join(f"{lane}={limit}" for lane, limit in self.lane_limits.items())
+        print(f"Started {len(self._tasks)} summary job workers ({lanes}) ({self.queue.worker_id})")
+        self._tasks.append(asyncio.create_task(self._register()))
+
+    def notify(self, lane):
+        """有新工作時叫醒該通道閒置的 worker，不必等到下一次輪詢"""
+        wakeup = self._wakeups.get(lane)
+        if wakeup is not None:
+            wakeup.set()
+
+    async def stop(self):
+        for task in self._tasks:
+            task.cancel()
+        await asyncio.gather(*self._tasks, return_exceptions=True)
+        self._tasks = []
+        try:
+            await run_blocking(self.queue.unregister_workers)
+        except Exception as e:
+            print(f"Error unregistering summary job workers: {e}")
+
+    async def _register(self):
+        while True:
+            try:
+                await run_blocking(self.queue.register_workers, self.lane_limits)
+            except Exception as e:
+                print(f"Error registering summary job workers: {e}")
+            await asyncio.sleep(self.queue.lease_seconds / 3)
+
+    async def _run(self, application, lane):
+        wakeup = self._wakeups[lane]
+        while True:
+            try:
+                job = await run_blocking(self.queue.claim, lane)
+                if job is None:
+                    for exhausted in await run_blocking(self.queue.reap_exhausted):
+                        await notify_job_failed(application.bot, exhausted)
+            except Exception as e:
+                print(f"Error claiming summary job: {e}")
+                job = None
+            if job is None:
+                try:
+                    await asyncio.wait_for(wakeup.wait(), timeout=job_poll_interval)
+                except asyncio.TimeoutError:
+                    pass
+                wakeup.clear()
+                continue
+            await self._process(application, job)
+
+    async def _heartbeat(self, job_id):
+        while True:
+            await asyncio.sleep(self.queue.lease_seconds / 3)
+            try:
+                await run_blocking(self.queue.renew, job_id)
+            except Exception as e:
+                print(f"Error renewing lease for job {job_id}: {e}")
+
+    async def _process(self, application, job):
+        if job["attempts"] > 1:
+            print(f"Resuming summary job {job['_id']} from stage {job.get('stage')} (attempt {job['attempts']})")
+        heartbeat = asyncio.create_task(self._heartbeat(job["_id"]))
+        try:
+            await run_summary_job(application, job, self.queue)
+        finally:
+            heartbeat.cancel()
+
+summary_job_workers = SummaryJobWorkers(summary_job_queue, JOB_LANE_LIMITS)
+
+# 每位用戶在各聊天室交給背景 worker、尚未送達的摘要工作 ((chat_id, user_id) -> {job_id: asyncio.Event})
+# ChatOrderedUpdateProcessor 只讓可能是續問的訊息等待，續問不會在摘要送達前被當成新的文字摘要
+pending_summary_jobs = {}
+
+def mark_summary_job_pending(chat_id, user_id, job_id):
+    pending_summary_jobs.setdefault((chat_id, user_id), {})[job_id] = asyncio.Event()
+
+def release_summary_job(chat_id, user_id, job_id):
+    jobs = pending_summary_jobs.get((chat_id, user_id))
+    if jobs is None:
+        return
+    delivered = jobs.pop(job_id, None)
+    if delivered is not None:
+        delivered.set()
+    if not jobs:
+        del pending_summary_jobs[(chat_id, user_id)]
+
+async def wait_for_pending_summary_jobs(chat_id, user_id):
+    """等待用戶尚未送達的摘要工作；工作可能由其他 replica 處理，因此也定期查詢 MongoDB 的狀態"""
+    while True:
+        jobs = pending_summary_jobs.get((chat_id, user_id))
+        if not jobs:
+            return
+        job_id, delivered = next(iter(jobs.items()))
+        try:
+            await asyncio.wait_for(delivered.wait(), timeout=job_poll_interval)
+        except asyncio.TimeoutError:
+            try:
+                settled = await run_blocking(summary_job_queue.is_settled, job_id)
+            except Exception as e:
+                # 查不到工作狀態時不無限期卡住這位用戶
+                print(f"Error checking summary job {job_id}, no longer waiting: {e}")
+                settled = True
+            if settled:
+                release_summary_job(chat_id, user_id, job_id)
+
+class SingleFlight:
+    """
+    相同 key 的並行呼叫只執行一次，其餘呼叫等待同一個結果 (例外也會一併傳遞)
+    完成後立即移除，之後的重複請求交給摘要快取處理
+    """
+
+    def __init__(self):
+        self._in_flight = {}
+        self.executions = 0
+        self.coalesced = 0
+
+    async def run(self, key, func):
+        future = self._in_flight.get(key)
+        if future is not None:
+            self.coalesced += 1
+            print(f"Joining in-flight request for {key}")
+            return await asyncio.shield(future)
+
+        future = asyncio.ensure_future(func())
+        self._in_flight[key] = future
+        self.executions += 1
+
+        def release(done):
+            if self._in_flight.get(key) is done:
+                del self._in_flight[key]
+
+        future.add_done_callback(release)
+        # shield：等待者被取消時不影響其他共用同一結果的請求
+        return await asyncio.shield(future)
+
+extraction_flights = SingleFlight()  # key: 正規化網址
+summary_flights = SingleFlight()  # key: (正規化網址, 語言, 模型)
+
+async def notify_job_failed(bot, job):
+    try:
+        await bot.send_message(chat_id=job["chat_id"], text="處理您的請求時發生錯誤，請稍後再試。")
+    except Exception as e:
+        print(f"Error notifying chat {job.get('chat_id')}: {e}")
+
+# 擷取後會回傳的已知錯誤訊息
+CONTENT_ERROR_MESSAGES = [
+    "暫時無法轉錄",
+    "該影片沒有可用的字幕，且音頻轉換功能未啟用。",
+    "無法獲取字幕或進行音頻轉換。",
+    "音頻轉錄失敗。",
+    "無法從 Pocket Casts 頁面提取 RSS feed。",
+    "無法從 RSS feed 獲取 podcast episodes。",
+    "處理 Pocket Casts URL 時發生錯誤。",
+    "無法從 SoundOn 頁面提取 RSS feed。",
+    "處理 SoundOn URL 時發生錯誤。",
+    "無法從 Apple Podcast 提取 RSS feed。",
+    "處理 Apple Podcast URL 時發生錯誤。",
+    "Podcast 音頻轉錄失敗。"
+]
+
+def classify_job_lane(user_input, language, selected_model):
+    """
+    依預估成本將摘要工作分到通道 (阻塞，需在執行緒池中呼叫)
+    只查詢摘要快取與已快取的 yt-dlp info，不在聊天室的處理順序中執行 yt-dlp 擷取
+    """
+    if not is_url(user_input):
+        return "text"
+    # 摘要快取命中時不需要擷取，交給最輕的通道
+    if has_cached_summary(summary_cache_key(user_input, language, selected_model)):
+        return "text"
+    if is_pocketcasts_url(user_input) or is_soundon_url(user_input) or is_apple_podcast_url(user_input):
+        return "podcast"
+    if not matches_video_site(user_input):
+        return "web"
+    info = ytdlp_info_cache.peek(user_input)
+    if info is None:
+        # 沒有 info 時依網址判斷：YouTube 幾乎都有 (自動) 字幕，其他影片網站多半需要音頻轉錄
+        if re.search(r'youtube\.com|youtu\.be', user_input.lower()) or not use_audio_fallback:
+            return "video"
+        return "audio"
+    if transcript_store.get(video_transcript_key(info)):
+        return "video"
+    for key in ('subtitles', 'automatic_captions'):
+        if any(lang in (info.get(key) or {}) for lang in ['en', 'zh-Hant', 'zh-Hans', 'zh']):
+            return "video"
+    # 沒有字幕時會走音頻轉錄；未啟用時很快就會回報錯誤，仍視為一般影片
+    return "audio" if use_audio_fallback else "video"
+
+async def run_summary_job(application, job, queue=None):
+    """
+    執行一個摘要工作：擷取 → 摘要 → 發送，每完成一個階段就寫入檢查點
+    job 重新被領取時會跳過已完成的階段；queue 為 None 時不寫檢查點 (在 handler 內直接處理)
+    發送階段與 delivered 檢查點之間若當機，重試時會重複發送一次 (at-least-once)
+    """
+    bot = application.bot
+    chat_id = job["chat_id"]
+    user_id = job["user_id"]
+    user_input = job["user_input"]
+    language = job["language"]
+    selected_model = job["selected_model"]
+    processing_message_id = job.get("processing_message_id")
+
+    async def checkpoint(stage, **fields):
+        job.update(fields)
+        job["stage"] = stage
+        if stage == "delivered":
+            release_summary_job(chat_id, user_id, job["_id"])
+        if queue is not None:
+            try:
+                await run_blocking(queue.checkpoint, job["_id"], stage, fields)
+            except Exception as e:
+                print(f"Error checkpointing job {job['_id']} at {stage}: {e}")
+
+    async def finish(status, error=None):
+        release_summary_job(chat_id, user_id, job["_id"])
+        if queue is not None:
+            try:
+                await run_blocking(queue.finish, job["_id"], status, error)
+            except Exception as e:
+                print(f"Error finishing job {job['_id']}: {e}")
+
+    async def delete_processing_message():
+        if show_processing and processing_message_id:
+            try:
+                await bot.delete_message(chat_id=chat_id, message_id=processing_message_id)
+            except Exception as e:
+                print(f"Error deleting processing message: {e}")
+
+    try:
+        stage = job.get("stage")
+
+        if stage is None:
+            if job.get("queue_position") and show_processing and processing_message_id:
+                # 先前回報過排隊位置，開始處理時改回處理中
+                try:
+                    await bot.edit_message_text(chat_id=chat_id, message_id=processing_message_id, text="處理中，請稍候...")
+                except Exception as e:
+                    print(f"Error updating processing message: {e}")
+
+            # 先查詢摘要快取，命中時跳過所有擷取、轉錄與 LLM 呼叫
+            cache_key = None
+            cached = None
+            if enable_summary_cache and is_url(user_input):
+                cache_key = summary_cache_key(user_input, language, selected_model or model)
+                cached = await run_blocking(get_cached_summary, cache_key)
+                cached_text_array = await run_blocking(load_cached_original_content, cached) if cached else None
+                if cached_text_array is None:
+                    cached = None  # 原始內容已不存在時視為未命中
+
+            if cached:
+                print(f"Summary cache hit for {user_input}")
+                await checkpoint(
+                    "summarized",
+                    text_array=cached_text_array,
+                    summary=cached['summary'],
+                    title=cached['title'],
+                )
+            else:
+                title = None
+                if is_url(user_input):
+                    # 同一網址正在擷取 / 轉錄時，等待同一個結果，不重複執行 yt-dlp 或 Whisper
+                    text_array, title = await extraction_flights.run(
+                        canonicalize_url(user_input),
+                        lambda: run_blocking(extract_content_and_title, user_input),
+                    )
+                else:
+                    text_array = await run_blocking(process_user_input, user_input)
+
+                # 處理 scrape_text_from_url 返回 tuple 的情況
+                if isinstance(text_array, tuple):
+                    if len(text_array) == 2 and not text_array[0]:
+                        await delete_processing_message()
+                        await bot.send_message(chat_id=chat_id, text=text_array[1])
+                        await finish("failed", text_array[1])
+                        return
+                    text_array = text_array[0]
+
+                # 檢查是否為已知的錯誤訊息
+                if isinstance(text_array, list) and len(text_array) == 1 and text_array[0] in CONTENT_ERROR_MESSAGES:
+                    await delete_processing_message()
+                    await bot.send_message(chat_id=chat_id, text=text_array[0])
+                    await finish("failed", text_array[0])
+                    return
+
+                if not text_array:
+                    await bot.send_message(
+                        chat_id=chat_id,
+                        text="無法處理輸入的文本。請確保提供了有效的文本或URL。"
+                    )
+                    await finish("failed", "empty content")
+                    return
+
+                transcribed = job.get("lane") in TRANSCRIBED_JOB_LANES
+                await checkpoint(
+                    "transcribed" if transcribed else "fetched", text_array=text_array, cache_key=cache_key, title=title
+                )
+
+        if job["stage"] in ("fetched", "transcribed"):
+            on_delta = None
+            if stream_summary and show_processing and processing_message_id:
+                editor = ProgressiveMessageEditor(bot, chat_id, processing_message_id)
+                on_delta = editor.on_delta
+
+            async def produce_summary():
+                summary = await summarize(job["text_array"], language=language, selected_model=selected_model, on_delta=on_delta)
+                # 標題在擷取時已一併取得；舊的檢查點沒有標題時才另外查詢
+                title = job.get("title") or await run_blocking(get_web_title, user_input)
+                await run_blocking(store_cached_summary, job.get("cache_key"), user_input, language, selected_model or model, title, summary, job["text_array"])
+                return summary, title
+
+            if is_url(user_input):
+                # 同一網址 + 語言 + 模型正在摘要時，等待同一個結果 (串流只會顯示在第一個請求的訊息上)
+                summary_key = (canonicalize_url(user_input), language, selected_model or model)
+                summary, title = await summary_flights.run(summary_key, produce_summary)
+            else:
+                summary = await summarize(job["text_array"], language=language, selected_model=selected_model, on_delta=on_delta)
+                title = "短文之摘要"
+            await checkpoint("summarized", summary=summary, title=title)
+
+        if job["stage"] == "summarized":
+            text_array = job["text_array"]
+            summary = job["summary"]
+            title = job["title"]
+            if is_url(user_input):
+                original_url = user_input
+                summary_with_original = f"📌 {title}\n\n{summary}\n\n▶ {original_url}"
+            else:
+                original_url = None
+                summary_with_original = f"📌 \n{summary}\n"
+
+            await delete_processing_message()
+
+            # 將 Markdown 轉換成 Telegram 支援的 HTML，長摘要在段落處分成多則訊息
+            formatted_summary = format_for_telegram(summary_with_original)
+            await send_html_message(bot, chat_id, formatted_summary)
+
+            # 續問用的對話紀錄必須在 delivered 檢查點之前保存：檢查點之後同一用戶的續問就不再等待，
+            # 若此時還沒有紀錄，續問會被當成新的文字摘要；保存失敗只記錄，不影響送達
+            content_document = None
+            try:
+                content_document = await run_blocking(build_content_document, text_array)
+                await conversation_store.start(
+                    user_id, content_document["_id"], text_array, summary, original_url or 'text input', language
+                )
+            except Exception as e:
+                print(f"Error saving conversation for job {job['_id']}: {e}")
+            await checkpoint("delivered")
+
+            # 以下在用戶收到摘要之後才執行，不影響回覆延遲；失敗只記錄，不再通知用戶或將工作標記為失敗
+            try:
+                if content_document is None:
+                    content_document = await run_blocking(build_content_document, text_array)
+
+                # 存儲摘要資訊到 MongoDB (背景批次寫入)，原始內容只以雜湊引用；
+                # 內容本身先同步寫入 contents collection，摘要紀錄不會引用到不存在的內容
+                stored_content_hash = None
+                if mongo_uri:
+                    try:
+                        await run_blocking(store_content_document, content_document)
+                        stored_content_hash = content_document["_id"]
+                    except Exception as e:
+                        print(f"Error storing content for job {job['_id']}, saving summary without content_hash: {e}")
+                summary_data = {
+                    "telegram_id": user_id,
+                    "url": original_url,
+                    "summary": summary_with_original,
+                    "content_hash": stored_content_hash,
+                    "language": language,  # 新增
+                    "timestamp": datetime.now()
+                }
+                summary_writer.submit(summary_data)
+
+                if enable_email:
+                    # 新增：將摘要寄送到指定郵箱
+                    # 注意：需要一個主要收件人，而不僅是抄送列表
+                    if smtp_user:  # 使用發件人地址作為主要收件人
+                        await run_blocking(send_summary_via_email, summary_with_original, smtp_user, subject=title)
+                    else:
+                        print("無法發送郵件：缺少主要收件人地址")
+
+                # 發送摘要到 Discord Webhook（如果啟用）
+                if enable_discord_webhook:
+                    discord_message = f"🔔 新的摘要已生成：\n{summary_with_original}"
+                    await run_blocking(send_to_discord, discord_message)
+            except Exception as e:
+                print(f"Error in post-delivery steps for job {job['_id']}: {e}")
+
+        await finish("done")
+    except Exception as e:
+        print(f"Error in summary job: {e}")
+        await notify_job_failed(bot, job)
+        await finish("failed", str(e))
+
 async def handle(action, update, context):
     chat_id = update.effective_chat.id
     user_id = update.effective_user.id
@@ -1294,6 +3921,7 @@ async def handle(action, update, context):
      /boa - Book of Answers 解答之書
      /context - Show current context (顯示對話上下文)
      /clear - Clear conversation history (清除對話歷史)
+     /stats - Show runtime statistics (執行狀態統計)
      /yt2audio <Video URL> - Download video audio (支援 YouTube、Vimeo、Bilibili 等)
      /yt2text <Video URL> - Convert video to text (支援 YouTube、Vimeo、Bilibili 等)    
    You can also send me any text or URL to summarize.
@@ -1321,7 +3949,7 @@ async def handle(action, update, context):
             )
         elif action == 'clear_context':
             # 清除對話歷史
-            context.user_data['conversation_history'] = None
+            await conversation_store.clear(user_id)
             await context.bot.edit_message_text(
                 chat_id=chat_id,
                 message_id=processing_message.message_id,
@@ -1329,13 +3957,13 @@ async def handle(action, update, context):
             )
         elif action == 'show_context':
             # 顯示當前對話上下文
-            history = context.user_data.get('conversation_history')
+            history = await conversation_store.get(user_id)
             if history:
                 info_text = f"📋 當前對話上下文 / Current Context:\n\n"
                 info_text += f"🔗 來源 Source: {history.get('source_url', 'N/A')}\n"
                 info_text += f"📅 時間 Time: {history.get('timestamp', 'N/A')}\n"
                 info_text += f"💬 問答輪數 Q&A rounds: {len(history.get('messages', []))}\n"
-                info_text += f"📝 內容長度 Content length: {len(history.get('original_content', []))} paragraphs\n\n"
+                info_text += f"📝 內容長度 Content length: {len(history.get('passages', []))} passages\n\n"
                 info_text += "你可以繼續提問或發送新的 URL 開始新摘要。\nYou can continue asking or send a new URL to start fresh."
             else:
                 info_text = "📭 目前沒有對話歷史。\nNo conversation history available."
@@ -1382,10 +4010,16 @@ async def handle(action, update, context):
                     text=f"🤖 當前模型: {current_model}\n\n請選擇模型:",
                     reply_markup=reply_markup
                 )
+        elif action == 'stats':
+            await context.bot.edit_message_text(
+                chat_id=chat_id,
+                message_id=processing_message.message_id,
+                text=format_runtime_stats(await conversation_store.usage())
+            )
         elif action == 'boa':
             # 取回解答之書的回答
             try:
-                response = requests.get(ANSWER_BOOK_API, timeout=10)
+                response = await run_blocking(requests.get, ANSWER_BOOK_API, timeout=10)
                 response.raise_for_status()
                 data = response.json()
                 answer = data.get('answer', '無法取得回答')
@@ -1410,8 +4044,8 @@ async def handle(action, update, context):
                 user_input = update.message.text
                 
                 # 檢查是否為續問
-                history = context.user_data.get('conversation_history')
-                if history and not is_url(user_input) and len(user_input) < 500:
+                history = await conversation_store.get(user_id)
+                if history and is_followup_candidate(user_input):
                     # 處理續問
                     language = context.user_data.get('language', 'zh-TW')
                     
@@ -1420,28 +4054,36 @@ async def handle(action, update, context):
                         {"role": "system", "content": "You are a helpful assistant that answers questions about previously summarized content."}
                     ]
                     
-                    # 添加原始內容
-                    original_content = "\n".join(history.get('original_content', []))
-                    messages.append({"role": "user", "content": f"Original content:\n{original_content[:3000]}"})  # 限制長度
+                    # 依 token 預算分配：先保留問題與最近的對話，再放摘要，剩下的額度給原始內容
+                    selected_model = context.user_data.get('selected_model', None)
+                    budget = min(followup_context_tokens, input_token_budget(selected_model or model))
+                    recent_messages = history.get('messages', [])[-3:]  # 只保留最近3輪對話
+                    remaining = budget - estimate_messages_tokens(messages + recent_messages + [{"role": "user", "content": user_input}])
+                    summary_text = truncate_to_tokens(history.get('summary', ''), remaining // 2)
+                    remaining -= estimate_tokens(summary_text) + 8
+
+                    # 添加原始內容：只附上與問題最相關的段落 (BM25 檢索)，依原文順序排列
+                    passages = await run_blocking(
+                        select_passages, history.get('content_hash'), history.get('passages', []), user_input, remaining
+                    )
+                    relevant_content = "\n...\n".join(passages)
+                    messages.append({"role": "user", "content": f"Original content (relevant excerpts):\n{relevant_content}"})
                     
                     # 添加摘要
-                    messages.append({"role": "assistant", "content": f"Summary:\n{history.get('summary', '')[:2000]}"})
+                    messages.append({"role": "assistant", "content": f"Summary:\n{summary_text}"})
                     
                     # 添加之前的對話
-                    for msg in history.get('messages', [])[-3:]:  # 只保留最近3輪對話
+                    for msg in recent_messages:
                         messages.append(msg)
                     
                     # 添加當前問題
                     messages.append({"role": "user", "content": user_input})
                     
                     # 呼叫 API (使用用戶選擇的模型)
-                    selected_model = context.user_data.get('selected_model', None)
-                    answer = call_gpt_api(user_input, messages[:-1], selected_model=selected_model)  # messages[:-1] 因為 call_gpt_api 會自己添加最後的 user message
+                    answer = await call_gpt_api(user_input, messages[:-1], selected_model=selected_model)  # messages[:-1] 因為 call_gpt_api 會自己添加最後的 user message
                     
                     # 保存對話歷史
-                    history['messages'].append({"role": "user", "content": user_input})
-                    history['messages'].append({"role": "assistant", "content": answer})
-                    context.user_data['conversation_history'] = history
+                    await conversation_store.add_exchange(user_id, history, user_input, answer)
                     
                     if show_processing and processing_message:
                         await context.bot.delete_message(chat_id=chat_id, message_id=processing_message.message_id)
@@ -1449,117 +4091,42 @@ async def handle(action, update, context):
                     await context.bot.send_message(chat_id=chat_id, text=f"💬 續問回答:\n\n{answer}")
                     return
                 
-                # 正常的摘要流程
-                text_array = process_user_input(user_input)
-                
-                # 檢查是否為已知的錯誤訊息
-                error_msgs = [
-                    "暫時無法轉錄",
-                    "該影片沒有可用的字幕，且音頻轉換功能未啟用。",
-                    "無法獲取字幕或進行音頻轉換。",
-                    "音頻轉錄失敗。",
-                    "無法從 Pocket Casts 頁面提取 RSS feed。",
-                    "無法從 RSS feed 獲取 podcast episodes。",
-                    "處理 Pocket Casts URL 時發生錯誤。",
-                    "無法從 SoundOn 頁面提取 RSS feed。",
-                    "處理 SoundOn URL 時發生錯誤。",
-                    "無法從 Apple Podcast 提取 RSS feed。",
-                    "處理 Apple Podcast URL 時發生錯誤。",
-                    "Podcast 音頻轉錄失敗。"
-                ]
-                
-                # 處理 scrape_text_from_url 返回 tuple 的情況
-                if isinstance(text_array, tuple):
-                    if len(text_array) == 2 and not text_array[0]:
-                        if show_processing and processing_message:
-                            await context.bot.delete_message(chat_id=chat_id, message_id=processing_message.message_id)
-                        await context.bot.send_message(chat_id=chat_id, text=text_array[1])
-                        return
-                    else:
-                        text_array = text_array[0]
-                        
-                if isinstance(text_array, list) and len(text_array) == 1 and text_array[0] in error_msgs:
-                    if show_processing and processing_message:
-                        await context.bot.delete_message(chat_id=chat_id, message_id=processing_message.message_id)
-                    await context.bot.send_message(chat_id=chat_id, text=text_array[0])
-                    return
-
-                if text_array:
-                    # 獲取用戶語言偏好和選擇的模型
-                    language = context.user_data.get('language', 'zh-TW')
-                    selected_model = context.user_data.get('selected_model', None)
-                    
-                    summary = summarize(text_array, language=language, selected_model=selected_model)
-                    if is_url(user_input):
-                        original_url = user_input
-                        title = get_web_title(user_input)
-                        summary_with_original = f"📌 {title}\n\n{summary}\n\n▶ {original_url}"
-                    else:
-                        original_url = None
-                        title = "短文之摘要"  
-                        summary_with_original = f"📌 \n{summary}\n"
-                    
-                    # 保存對話歷史到 context.user_data
-                    context.user_data['conversation_history'] = {
-                        'original_content': text_array,
-                        'summary': summary,
-                        'source_url': original_url or 'text input',
-                        'timestamp': datetime.now().strftime('%Y-%m-%d %H:%M:%S'),
-                        'messages': [],
-                        'language': language
-                    }
-                    
-                    # 移除這一行，不需要轉義普通文本
-                    # 在使用時加入條件判斷
-                    if enable_email:
-                        # 新增：將摘要寄送到指定郵箱
-                        # 注意：需要一個主要收件人，而不僅是抄送列表
-                        if smtp_user:  # 使用發件人地址作為主要收件人
-                            send_summary_via_email(summary_with_original, smtp_user, subject=title)
-                        else:
-                            print("無法發送郵件：缺少主要收件人地址")
-                    
-                    # 存儲摘要資訊到 MongoDB
-                    summary_data = {
-                        "telegram_id": user_id,
-                        "url": original_url,
-                        "summary": summary_with_original,
-                        "original_content": text_array,  # 新增
-                        "language": language,  # 新增
-                        "timestamp": datetime.now()
-                    }
-                    summary_collection.insert_one(summary_data)
-                    
-                    if show_processing and processing_message:
-                        await context.bot.delete_message(chat_id=chat_id, message_id=processing_message.message_id)
-                    
-                    # 發送摘要到 Discord Webhook（如果啟用）
-                    if enable_discord_webhook:
-                        discord_message = f"🔔 新的摘要已生成：\n{summary_with_original}"
-                        send_to_discord(discord_message)
-                    
-                    # 處理長消息，將 Markdown 轉換成 Telegram 支援的 HTML
-                    formatted_summary = format_for_telegram(summary_with_original)
-                    
-                    if len(formatted_summary) > 4000:
-                        parts = [formatted_summary[i:i+4000] for i in range(0, len(formatted_summary), 4000)]
-                        for part in parts:
-                            await context.bot.send_message(
+                # 正常的摘要流程：建立工作交給背景 worker 處理
+                job = {
+                    "_id": uuid.uuid4().hex,
+                    "chat_id": chat_id,
+                    "user_id": user_id,
+                    "user_input": user_input,
+                    "language": context.user_data.get('language', 'zh-TW'),
+                    "selected_model": context.user_data.get('selected_model', None),
+                    "processing_message_id": processing_message.message_id if processing_message else None,
+                    "stage": None,
+                }
+                if enable_job_queue:
+                    try:
+                        job["lane"] = await run_blocking(
+                            classify_job_lane, user_input, job["language"], job["selected_model"] or model
+                        )
+                        # 送達前同一用戶的續問會等待 (見 ChatOrderedUpdateProcessor)
+                        mark_summary_job_pending(chat_id, user_id, job["_id"])
+                        await run_blocking(summary_job_queue.enqueue, job)
+                        summary_job_workers.notify(job["lane"])
+                        # 通道的 worker 都在忙時回報排隊位置
+                        ahead, running, capacity = await run_blocking(summary_job_queue.queue_position, job)
+                        position = ahead + 1
+                        if (running >= capacity and processing_message
+                                and await run_blocking(summary_job_queue.mark_queue_position, job["_id"], position)):
+                            await context.bot.edit_message_text(
                                 chat_id=chat_id,
-                                text=part,
-                                parse_mode='HTML'
+                                message_id=processing_message.message_id,
+                                text=f"⏳ 已加入{JOB_LANE_NAMES.get(job['lane'], '')}佇列，目前排在第 {position} 位，請稍候...\n"
+                                     f"Queued, position {position}."
                             )
-                    else:
-                        await context.bot.send_message(
-                            chat_id=chat_id,
-                            text=formatted_summary,
-                            parse_mode='HTML'
-                        )
-                else:
-                    await context.bot.send_message(
-                        chat_id=chat_id,
-                        text="無法處理輸入的文本。請確保提供了有效的文本或URL。"
-                    )
+                        return
+                    except Exception as e:
+                        print(f"Error enqueueing summary job, processing inline: {e}")
+                        release_summary_job(chat_id, user_id, job["_id"])
+                await run_summary_job(context.application, job)
             except Exception as e:
                 print(f"Error in summarize action: {e}")
                 await context.bot.send_message(
@@ -1607,11 +4174,15 @@ async def handle(action, update, context):
                     md = MarkItDown(llm_client=client, llm_model=model)
                 else:
                     print("[DEBUG] 進入文件摘要模式")
-                    md = MarkItDown()
                 print("[DEBUG] 開始 markitdown 轉換")
                 try:
-                    result = md.convert(file_path)
-                    text = result.text_content
+                    if ext.lower() in image_exts:
+                        # 圖片摘要需要 llm_client，無法跨行程傳遞，在執行緒池中轉換
+                        result = await run_blocking(md.convert, file_path)
+                        text = result.text_content
+                    else:
+                        # 文件解析是 CPU 密集工作，交給行程池
+                        text = await run_cpu_bound(convert_document_to_text, file_path)
                     print(f"[DEBUG] markitdown 轉換完成，text 長度={len(text)}")
                 except Exception as e:
                     import traceback
@@ -1628,12 +4199,15 @@ async def handle(action, update, context):
                 os.remove(file_path)
                 print(f"[DEBUG] 已刪除暫存檔 {file_path}")
 
-                # 直接對整個文本進行一次性摘要，不需要分塊處理
-                # 因為 LLM 可以處理高達 1,000,000 個 token
+                # 對整個文本進行摘要，超過 MAP_REDUCE_THRESHOLD_TOKENS 時 summarize 會自動改用分段摘要
                 print(f"[DEBUG] 開始對整個文本進行摘要，文本長度: {len(text)} 字符")
                 language = context.user_data.get('language', 'zh-TW')
                 selected_model = context.user_data.get('selected_model', None)
-                summary = summarize([text], language=language, selected_model=selected_model)
+                on_delta = None
+                if stream_summary and processing_message:
+                    editor = ProgressiveMessageEditor(context.bot, chat_id, processing_message.message_id)
+                    on_delta = editor.on_delta
+                summary = await summarize(chunk_text(text), language=language, selected_model=selected_model, on_delta=on_delta)
 
                 # 轉義 Markdown 特殊字符
                 escaped_summary = escape_markdown(summary, version=2)
@@ -1648,15 +4222,10 @@ async def handle(action, update, context):
                 # 發送 PDF 摘要到 Discord Webhook（如果啟用）
                 if enable_discord_webhook:
                     discord_message = f"🔔 已成功處理一份 PDF 文件，摘要內容如下：\n{summary}"
-                    send_to_discord(discord_message)
+                    await run_blocking(send_to_discord, discord_message)
 
-                # 分批發送摘要
-                if len(summary) > 4000:
-                    parts = [summary[i:i+4000] for i in range(0, len(summary), 4000)]
-                    for part in parts:
-                        await context.bot.send_message(chat_id=chat_id, text=part)
-                else:
-                    await context.bot.send_message(chat_id=chat_id, text=summary)
+                # 分批發送摘要 (純文字跳脫後以 HTML 發送，顯示不變並可共用分段邏輯)
+                await send_html_message(context.bot, chat_id, html_lib.escape(summary, quote=False))
 
                 if processing_message:
                     try:
@@ -1677,9 +4246,37 @@ async def handle(action, update, context):
             await context.bot.send_message(chat_id=chat_id, text="發生錯誤，請稍後再試。")
         print(f"Error: {e}")
 
+async def on_startup(application):
+    """Application 啟動後建立 MongoDB 索引，並開始處理摘要工作佇列 (包含重啟前未完成的工作)"""
+    if not mongo_uri:
+        print("MONGO_URI is not set; summaries are processed inline and not persisted")
+        return
+    try:
+        await run_blocking(bootstrap_mongo_indexes)
+    except Exception as e:
+        print(f"Error creating MongoDB indexes: {e}")
+    if enable_job_queue:
+        summary_job_workers.start(application)
+
+async def on_shutdown(application):
+    """Application 關閉時停止 worker 並釋放長駐連線，未完成的工作留待重啟後繼續"""
+    await summary_job_workers.stop()
+    await llm_client_pool.aclose()
+    await run_blocking(summary_writer.close)
+    close_mongo_client()
+
 def main():
     try:
-        application = ApplicationBuilder().token(telegram_token).build()
+        update_processor = ChatOrderedUpdateProcessor(max_concurrent_updates, max_concurrent_heavy_updates)
+        application = (
+            ApplicationBuilder()
+            .token(telegram_token)
+            .concurrent_updates(update_processor)
+            .rate_limiter(telegram_rate_limiter)
+            .post_init(on_startup)
+            .post_shutdown(on_shutdown)
+            .build()
+        )
         start_handler = CommandHandler('start', handle_start)
         help_handler = CommandHandler('help', handle_help)
         lang_handler = CommandHandler('lang', handle_language)
@@ -1688,6 +4285,7 @@ def main():
         boa_handler = CommandHandler('boa', handle_boa)
         clear_handler = CommandHandler('clear', handle_clear_context)
         context_handler = CommandHandler('context', handle_show_context)
+        stats_handler = CommandHandler('stats', handle_stats)
         yt2audio_handler = CommandHandler('yt2audio', handle_yt2audio)
         yt2text_handler = CommandHandler('yt2text', handle_yt2text)
         set_my_commands(telegram_token)
@@ -1705,6 +4303,7 @@ def main():
         application.add_handler(boa_handler)
         application.add_handler(clear_handler)
         application.add_handler(context_handler)
+        application.add_handler(stats_handler)
         application.add_handler(yt2audio_handler)
         application.add_handler(yt2text_handler)
         application.add_handler(summarize_handler)
@@ -1712,6 +4311,8 @@ def main():
         application.run_polling()
     except Exception as e:
         print(e)
+    finally:
+        shutdown_executors()
 
 if __name__ == '__main__':
     main()
\ No newline at end of file
@@ -0,0 +1,118 @@
+"""
+將 summaries 與 summary_cache collection 內嵌的 original_content 搬到以內容雜湊為 key 的 contents collection (壓縮保存)，
+兩者改為只保存 content_hash，並輸出儲存空間縮減報告。
+
+用法 (使用與 bot 相同的 .env / MONGO_URI)：
+    python migrate_original_content.py --dry-run     # 只計算報告，不修改資料
+    python migrate_original_content.py               # 實際搬移
+    python migrate_original_content.py --batch-size 200
+"""
+import argparse
+
+import bson
+from pymongo import UpdateOne
+
+from main import build_content_document, content_collection, get_mongo_db, summary_cache_collection, summary_collection
+
+MIGRATED_COLLECTIONS = ("summaries", "summary_cache")
+
+
+def collection_size(name):
+    """collStats 回報的資料大小與儲存大小 (bytes)，無法取得時返回 None"""
+    try:
+        stats = get_mongo_db().command("collStats", name)
+        return stats.get("size"), stats.get("storageSize")
+    except Exception as e:
+        print(f"collStats unavailable for {name}: {e}")
+        return None
+
+
+def flush(collection, content_ops, summary_ops):
+    # 先寫入內容再更新摘要，中途中斷也不會出現引用不存在內容的摘要
+    if content_ops:
+        content_collection.bulk_write(content_ops, ordered=False)
+    if summary_ops:
+        collection.bulk_write(summary_ops, ordered=False)
+    content_ops.clear()
+    summary_ops.clear()
+
+
+def migrate(dry_run, batch_size):
+    totals = {
+        "summaries": 0,
+        "summary_cache": 0,
+        "unique_contents": 0,
+        "embedded_bytes": 0,  # original_content 內嵌在 summaries / summary_cache 時的 BSON 大小
+        "raw_content_bytes": 0,  # 去重後的原始內容 (JSON UTF-8) 大小
+        "stored_bytes": 0,  # 去重 + 壓縮後 contents 文件的 BSON 大小
+    }
+    seen = set()
+    content_ops = []
+    summary_ops = []
+
+    before = {name: collection_size(name) for name in MIGRATED_COLLECTIONS + ("contents",)}
+
+    for name, collection in (("summaries", summary_collection), ("summary_cache", summary_cache_collection)):
+        cursor = collection.find({"original_content": {"$exists": True}}, {"original_content": 1})
+        for document in cursor:
+            text_array = document.get("original_content") or []
+            content_document = build_content_document(text_array)
+            content_id = content_document["_id"]
+
+            totals[name] += 1
+            totals["embedded_bytes"] += len(bson.encode({"original_content": text_array}))
+            if content_id not in seen:
+                seen.add(content_id)
+                totals["unique_contents"] += 1
+                totals["raw_content_bytes"] += content_document["raw_size"]
+                totals["stored_bytes"] += len(bson.encode(content_document))
+                content_ops.append(UpdateOne({"_id": content_id}, {"$setOnInsert": content_document}, upsert=True))
+
+            summary_ops.append(UpdateOne(
+                {"_id": document["_id"]},
+                {"$set": {"content_hash": content_id}, "$unset": {"original_content": ""}},
+            ))
+
+            if len(summary_ops) >= batch_size:
+                if not dry_run:
+                    flush(collection, content_ops, summary_ops)
+                else:
+                    content_ops.clear()
+                    summary_ops.clear()
+                print(f"Processed {totals[name]} {name} documents...")
+
+        if not dry_run:
+            flush(collection, content_ops, summary_ops)
+        else:
+            content_ops.clear()
+            summary_ops.clear()
+
+    print("")
+    print("=== Original content storage report ===")
+    print(f"Summaries with embedded original_content: {totals['summaries']}")
+    print(f"Cache entries with embedded content:      {totals['summary_cache']}")
+    print(f"Unique contents:                          {totals['unique_contents']}")
+    print(f"Embedded size (before):                   {totals['embedded_bytes'] / 1024 / 1024:.2f} MB")
+    print(f"Deduplicated raw size:                    {totals['raw_content_bytes'] / 1024 / 1024:.2f} MB")
+    print(f"Deduplicated + compressed size (after):   {totals['stored_bytes'] / 1024 / 1024:.2f} MB")
+    if totals["embedded_bytes"]:
+        reduction = 1 - totals["stored_bytes"] / totals["embedded_bytes"]
+        print(f"Reduction:                                {reduction:.1%}")
+
+    if not dry_run:
+        after = {name: collection_size(name) for name in MIGRATED_COLLECTIONS + ("contents",)}
+        for name in MIGRATED_COLLECTIONS + ("contents",):
+            if before[name] and after[name]:
+                print(f"collStats {name}: size {before[name][0]} -> {after[name][0]} bytes, "
+                      f"storageSize {before[name][1]} -> {after[name][1]} bytes")
+        print("Note: WiredTiger reuses freed space; run compact on summaries and summary_cache to return it to the OS.")
+    else:
+        print("(dry run, no documents were modified)")
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Move embedded original_content of summaries and cache entries into the content-hash-keyed contents collection")
+    parser.add_argument("--dry-run", action="store_true", help="only print the storage report")
+    parser.add_argument("--batch-size", type=int, default=500, help="documents per bulk write")
+    args = parser.parse_args()
+    migrate(args.dry_run, args.batch_size)
@@ -0,0 +1,72 @@
+import os
+import random
+import sys
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
+
+from main import chunk_text, estimate_tokens
+
+CHUNK_SIZE = 2100
+
+def legacy_chunker(text, chunk_size=CHUNK_SIZE):
+    """舊版逐字累加的分段方式 (字串重複相加，長文時為二次方成本，且中文整段沒有空白會被當成一個字)"""
+    output_chunks = []
+    current_chunk = ""
+    for word in text.split():
+        if len(current_chunk) + len(word) + 1 <= chunk_size:
+            current_chunk += word + ' '
+        else:
+            output_chunks.append(current_chunk.strip())
+            current_chunk = word + ' '
+    if current_chunk:
+        output_chunks.append(current_chunk.strip())
+    return output_chunks
+
+def english_transcript(words=100_000):
+    random.seed(0)
+    vocabulary = ["the", "model", "transcript", "video", "summary", "we", "talk", "about", "really",
+                  "interesting", "language", "and", "so", "basically", "you", "know", "performance"]
+    sentences = []
+    count = 0
+    while count < words:
+        length = random.randint(6, 20)
+        sentence = " ".join(random.choice(vocabulary) for _ in range(length))
+        sentences.append(sentence.capitalize() + random.choice([".", "?", "!"]))
+        count += length
+    return " ".join(sentences)
+
+def chinese_transcript(chars=150_000):
+    random.seed(1)
+    vocabulary = "我們今天來聊一下這個影片的重點其實大家都知道語言模型的效能非常重要所以要注意"
+    sentences = []
+    count = 0
+    while count < chars:
+        length = random.randint(8, 40)
+        sentences.append("".join(random.choice(vocabulary) for _ in range(length)) + random.choice("。！？，"))
+        count += length
+    return "".join(sentences)
+
+def bench(name, func, text, repeat=3):
+    best = float("inf")
+    for _ in range(repeat):
+        start = time.perf_counter()
+        chunks = func(text)
+        best = min(best, time.perf_counter() - start)
+    print(f"{name:<32} {best * 1000:8.1f} ms  {len(chunks):5d} chunks  max {max(len(c) for c in chunks)} chars")
+    return chunks
+
+def check(chunks, text, limit, measure=len):
+    assert all(measure(chunk) <= limit for chunk in chunks), "chunk exceeds limit"
+    # 分段只在空白處損失內容
+    assert "".join("".join(chunks).split()) == "".join(text.split()), "content lost"
+
+if __name__ == "__main__":
+    for label, text in [("English 100k words", english_transcript()), ("Chinese 150k chars", chinese_transcript())]:
+        print(f"--- {label}: {len(text)} chars, ~{estimate_tokens(text)} tokens ---")
+        bench("legacy word loop", legacy_chunker, text)
+        chunks = bench("chunk_text (chars)", lambda t: chunk_text(t, CHUNK_SIZE, "chars"), text)
+        check(chunks, text, CHUNK_SIZE)
+        chunks = bench("chunk_text (tokens, 1000)", lambda t: chunk_text(t, 1000, "tokens"), text)
+        check(chunks, text, 1000, measure=estimate_tokens)
+    print("OK")
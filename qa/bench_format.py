@@ -0,0 +1,157 @@
+import glob
+import html
+import os
+import re
+import sys
+import time
+
+import markdown
+from bs4 import BeautifulSoup
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
+
+from main import TELEGRAM_MESSAGE_LIMIT, format_for_telegram, split_telegram_html, telegram_text_length
+
+FIXTURE_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), "format_fixtures")
+
+# 刻意與舊版不同的 fixture：舊版巢狀 / 鬆散清單會產生 "• \n" 空項目並把子項目併入父項目，
+# 舊版也會把 x<y and y>z、<angle> 當成 HTML 標籤吃掉文字，並輸出未跳脫的 < & (Telegram 會拒收)；
+# ***粗斜體*** 舊版只留純文字，新版輸出 <b><i>
+INTENDED_DIFFERENCES = {"nested_lists.md", "special_chars.md", "emphasis.md"}
+
+TELEGRAM_TAG_PATTERN = re.compile(r"</?([a-zA-Z-]+)[^>]*>")
+TELEGRAM_ALLOWED_TAGS = {"b", "i", "u", "s", "a", "code", "pre", "blockquote", "tg-spoiler"}
+
+def legacy_format_for_telegram(markdown_text):
+    """
+    舊版實作 (markdown → HTML → BeautifulSoup 多次 find_all → unescape)，保留作為輸出比對與效能基準
+    將 Markdown 轉換成 Telegram 支援的有限 HTML 標籤
+    Telegram 僅支援 <b>, <i>, <u>, <s>, <a>, <code>, <pre>, <tg-spoiler> 等
+    不支援 <h1>~<h6>, <ul>, <li>, <p>, <br> 等標準 HTML
+    """
+    if not markdown_text:
+        return markdown_text
+        
+    try:
+        # 1. 將 Markdown 轉成完整 HTML
+        html = markdown.markdown(markdown_text, extensions=['nl2br'])
+        
+        # 2. 使用 BeautifulSoup 進行標籤轉換與過濾
+        soup = BeautifulSoup(html, 'html.parser')
+        
+        # 把標題 (<h1>~<h6>) 轉換為粗體並加換行
+        for v in soup.find_all(['h1', 'h2', 'h3', 'h4', 'h5', 'h6']):
+            new_text = f"<b>{v.get_text()}</b>\n\n"
+            v.replace_with(new_text)
+            
+        # 把清單項 (<li>) 轉換為帶有 bullet point 的文字
+        for li in soup.find_all('li'):
+            li.replace_with(f"• {li.get_text()}\n")
+            
+        # 移除 <ul> 和 <ol> 的外層包裹
+        for ul in soup.find_all(['ul', 'ol']):
+            ul.unwrap()
+            
+        # 把 <p> 轉換成帶有換行的純文字
+        for p in soup.find_all('p'):
+            p.replace_with(f"{p.get_text()}\n\n")
+            
+        # 把 <br> 替換為實際的換行符號
+        for br in soup.find_all('br'):
+            br.replace_with("\n")
+            
+        # 把 <hr> 替換為分隔線文字
+        for hr in soup.find_all('hr'):
+            hr.replace_with("\n----------\n")
+            
+        # 把 <strong> 轉換為 <b>
+        for strong in soup.find_all('strong'):
+            strong.name = 'b'
+            
+        # 把 <em> 轉換為 <i>
+        for em in soup.find_all('em'):
+            em.name = 'i'
+            
+        # 取得純文字並只保留 Telegram 允許的標籤
+        final_text = str(soup)
+        
+        # html.parser 的 unwrap 跟 replace_with 可能會留下多餘的全形空白或疊加換行，簡單清理
+        final_text = re.sub(r'\n{3,}', '\n\n', final_text)
+        # unescape 避免 &amp; 等實體在 Telegram 中顯示異常（雖然 Telegram HTML mode 有些自動處理，但清乾淨比較保險）
+        import html as html_lib
+        final_text = html_lib.unescape(final_text)
+        
+        return final_text.strip()
+    except Exception as e:
+        print(f"Error formatting for Telegram: {e}")
+        return markdown_text # 如果轉換失敗，退回原始文字
+
+
+def load_fixtures():
+    fixtures = {}
+    for path in sorted(glob.glob(os.path.join(FIXTURE_DIR, "*.md"))):
+        with open(path, encoding="utf-8") as f:
+            fixtures[os.path.basename(path)] = f.read()
+    return fixtures
+
+def check_valid_html(name, rendered):
+    # 移除允許的標籤後不應再有 < >，& 只能以實體出現
+    assert all(tag.lower() in TELEGRAM_ALLOWED_TAGS for tag in TELEGRAM_TAG_PATTERN.findall(rendered)), f"{name}: unsupported tag"
+    stripped = TELEGRAM_TAG_PATTERN.sub("", rendered)
+    assert "<" not in stripped and ">" not in stripped, f"{name}: unescaped angle bracket"
+    assert not re.search(r"&(?!(?:amp|lt|gt|quot|#\d+|#x[0-9a-fA-F]+);)", stripped), f"{name}: unescaped ampersand"
+
+def check(fixtures):
+    for name, text in fixtures.items():
+        legacy = legacy_format_for_telegram(text)
+        rendered = format_for_telegram(text)
+        check_valid_html(name, rendered)
+        if rendered == legacy:
+            status = "identical"
+        elif html.unescape(rendered) == legacy:
+            status = "identical (escaped < > &)"
+        else:
+            assert name in INTENDED_DIFFERENCES, f"{name}: output differs from legacy"
+            status = "intended difference"
+        print(f"{name:<24} {status}")
+
+def check_split(rendered):
+    parts = split_telegram_html(rendered)
+    for part in parts:
+        check_valid_html("split part", part)
+        assert telegram_text_length(html.unescape(TELEGRAM_TAG_PATTERN.sub("", part))) <= TELEGRAM_MESSAGE_LIMIT, "part too long"
+        tags = [(match.group(0).startswith("</"), match.group(1)) for match in TELEGRAM_TAG_PATTERN.finditer(part)]
+        stack = []
+        for closing, tag in tags:
+            if closing:
+                assert stack and stack.pop() == tag, "unbalanced tags"
+            else:
+                stack.append(tag)
+        assert not stack, "unclosed tag"
+    # 只在空白處分段，文字不會遺失
+    visible = lambda text: "".join(TELEGRAM_TAG_PATTERN.sub("", text).split())
+    assert visible("".join(parts)) == visible(rendered), "content lost"
+    return parts
+
+def bench(name, func, text, repeat=20):
+    best = float("inf")
+    for _ in range(repeat):
+        start = time.perf_counter()
+        func(text)
+        best = min(best, time.perf_counter() - start)
+    return best
+
+if __name__ == "__main__":
+    fixtures = load_fixtures()
+    check(fixtures)
+    print("")
+    # 長摘要：例如 map-reduce 後的長文摘要或多則摘要串接
+    long_summary = "\n\n".join(fixtures[name] for name in ("zh_summary.md", "en_summary.md")) * 20
+    cases = [(name, fixtures[name]) for name in ("zh_summary.md", "en_summary.md")] + [("long summary (x20)", long_summary)]
+    parts = check_split(format_for_telegram(long_summary))
+    print(f"split long summary into {len(parts)} parts: {[telegram_text_length(html.unescape(TELEGRAM_TAG_PATTERN.sub('', part))) for part in parts]}")
+    for label, text in cases:
+        legacy = bench("legacy", legacy_format_for_telegram, text)
+        rendered = bench("renderer", format_for_telegram, text)
+        print(f"{label:<24} {len(text):7d} chars  legacy {legacy * 1000:7.2f} ms  renderer {rendered * 1000:7.2f} ms  {legacy / rendered:5.1f}x")
+    print("OK")
@@ -0,0 +1,47 @@
+import asyncio
+import os
+import sys
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
+
+import main
+
+
+def run_map_summarize(stub, text, monkeypatch):
+    calls = []
+
+    async def call_gpt_api(prompt, messages, selected_model=None):
+        calls.append(prompt)
+        return stub(prompt)
+
+    monkeypatch.setattr(main, "call_gpt_api", call_gpt_api)
+    monkeypatch.setattr(main, "get_map_reduce_settings", lambda model_name: {"threshold": 2000, "chunk_tokens": 500, "fan_out": 4})
+    result = asyncio.run(main.map_summarize(text, "en", "stub-model"))
+    return result, calls
+
+
+def long_text(words=20000):
+    return " ".join(f"word{i % 50}." for i in range(words))
+
+
+def test_notes_that_never_shrink_stop_after_one_round(monkeypatch):
+    # 模型把輸入原封不動 (甚至更長) 地回傳時，不能無限呼叫 LLM
+    result, calls = run_map_summarize(lambda prompt: prompt + " extra", long_text(), monkeypatch)
+    first_round = len(main.chunk_text(long_text(), 500, "tokens"))
+    assert len(calls) == first_round
+    assert main.estimate_tokens(result) <= 2000
+
+
+def test_slowly_shrinking_notes_are_bounded_by_max_rounds(monkeypatch):
+    monkeypatch.setattr(main, "map_reduce_max_rounds", 3)
+    # 每輪只縮短一點，永遠到不了門檻
+    result, calls = run_map_summarize(lambda prompt: prompt[: int(len(prompt) * 0.95)], long_text(), monkeypatch)
+    rounds = sum(1 for prompt in calls if prompt.startswith("Part 1/"))
+    assert rounds == 3
+    assert main.estimate_tokens(result) <= 2000
+
+
+def test_shrinking_notes_converge_without_truncation(monkeypatch):
+    result, calls = run_map_summarize(lambda prompt: "short note.", long_text(), monkeypatch)
+    assert main.estimate_tokens(result) <= 2000
+    assert "short note." in result